@@ -1,6 +1,21 @@
-from maridatadownloader.cds import DownloaderCdsApiERA5
-from maridatadownloader.xarray import DownloaderXarrayCMEMS, DownloaderXarrayGFS, DownloaderXarrayETOPONCEI
-from maridatadownloader.copernicus_marine_toolbox import DownloaderCopernicusMarineToolboxApi
+import importlib
+
+from maridatadownloader.registry import get_downloader_factory, list_downloaders, register_downloader
+
+# Downloader classes are imported on first access so that only the backends which are actually used are loaded
+_LAZY_IMPORTS = {
+    'DownloaderCdsApiERA5': 'maridatadownloader.cds',
+    'DownloaderXarrayCMEMS': 'maridatadownloader.xarray',
+    'DownloaderXarrayGFS': 'maridatadownloader.xarray',
+    'DownloaderXarrayETOPONCEI': 'maridatadownloader.xarray',
+    'DownloaderCopernicusMarineToolboxApi': 'maridatadownloader.copernicus_marine_toolbox',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        return getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 
 class DownloaderFactory:
@@ -9,28 +24,9 @@ class DownloaderFactory:
 
     @classmethod
     def get_downloader(cls, downloader_type, platform=None, username=None, password=None, **kwargs):
-
-        if downloader_type.lower() == 'xarray':
-            if platform.lower() == 'gfs':
-                return DownloaderXarrayGFS(username=username, password=password, **kwargs)
-            elif platform.lower() == 'cmems':
-                assert 'product' in kwargs, "kwargs['product'] is required for platform=cmems"
-                assert 'product_type' in kwargs, "kwargs['product_type'] is required for platform=cmems"
-                assert username, "username is required for platform=cmems"
-                assert password, "password is required for platform=cmems"
-                return DownloaderXarrayCMEMS(kwargs.pop('product'), kwargs.pop('product_type'), username, password,
-                                             **kwargs)
-            elif platform.lower() == 'etoponcei':
-                return DownloaderXarrayETOPONCEI(**kwargs)
-            else:
-                raise ValueError(platform)
-        elif downloader_type.lower() == 'cmtapi':
-            if platform.lower() == 'cmems':
-                return DownloaderCopernicusMarineToolboxApi(username=username, password=password, **kwargs)
-            else:
-                raise ValueError(platform)
-        elif downloader_type.lower() == 'cdsapi':
-            if platform.lower() == 'era5':
-                return DownloaderCdsApiERA5(uuid=username, api_key=password, **kwargs)
-        else:
-            raise ValueError(downloader_type)
+        """
+        Create a downloader using the provider registered for downloader_type/platform
+        (see maridatadownloader.registry)
+        """
+        factory = get_downloader_factory(downloader_type, platform)
+        return factory(username=username, password=password, **kwargs)
@@ -0,0 +1,119 @@
+"""
+Out-of-core aggregation (temporal resampling and coarsening)
+
+The data is pushed chunk by chunk along the aggregation dimension (usually time). Only complete resampling bins or
+coarsening windows are reduced, the incomplete remainder of a chunk is carried over to the next one. Thus, the
+result is the same as reducing the full dataset at once, while only the reduced parts and a single chunk are held in
+memory.
+"""
+import logging
+
+import numpy
+import pandas
+import xarray
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingAggregator:
+    """
+    Aggregate a dataset which is pushed chunk by chunk along the aggregation dimension
+
+    Usage:
+        aggregator = StreamingAggregator(resample={'time': '1D'})
+        for chunk in chunks:
+            aggregator.push(chunk)
+        dataset = aggregator.finish()
+    """
+    def __init__(self, resample=None, coarsen=None, aggregation='mean'):
+        """
+        :param resample: dict, e.g. {'time': '1D'}
+        :param coarsen: dict, e.g. {'latitude': 4, 'longitude': 4}. Incomplete windows at the boundaries are trimmed.
+        :param aggregation: name of the reduction method, e.g. 'mean', 'min', 'max', 'sum', 'median', 'std'
+        """
+        if resample:
+            assert len(resample) == 1, "resampling is supported for a single dimension only"
+        self.resample = resample
+        self.coarsen = coarsen
+        self.aggregation = aggregation
+        self.dim = next(iter(resample)) if resample else None
+        # Origin of the resampling bins (fixed frequencies only), set by the first chunk so that the bins are
+        # aligned across chunks
+        self.origin = None
+        self.parts = []
+        self._carry = None
+
+    def aggregate(self, dataset):
+        """Reduce dataset at once"""
+        if self.resample:
+            dataset = getattr(dataset.resample(self.resample, **self._get_origin_kwargs(dataset)),
+                              self.aggregation)()
+        if self.coarsen:
+            coarsen = {dim: window for dim, window in self.coarsen.items() if dim in dataset.dims}
+            dataset = getattr(dataset.coarsen(coarsen, boundary='trim'), self.aggregation)()
+        return dataset
+
+    def finish(self):
+        """
+        Reduce the remainder and concatenate the reduced parts. Resampling bins without any data (e.g. at chunk
+        boundaries) are filled with NaN, consistent with resampling the full dataset.
+
+        :return: xarray.Dataset
+        """
+        if self._carry is not None and (self.resample or not self.parts):
+            # An incomplete coarsening window is trimmed unless it is all there is (consistent with boundary='trim')
+            self.parts.append(self.aggregate(self._carry))
+        self._carry = None
+        assert self.parts, "no data has been pushed"
+        dataset = xarray.concat(self.parts, dim=self.dim) if len(self.parts) > 1 else self.parts[0]
+        self.parts = []
+        if self.resample and self.dim in dataset.dims and dataset.sizes[self.dim] > 1:
+            labels = dataset.indexes[self.dim]
+            labels_full = pandas.date_range(labels[0], labels[-1], freq=self.resample[self.dim])
+            if len(labels_full) != len(labels):
+                dataset = dataset.reindex({self.dim: labels_full})
+        return dataset
+
+    def get_dim(self, dataset):
+        """:return: aggregation dimension or None if dataset doesn't have it (e.g. a single time step)"""
+        if self.dim is None:
+            self.dim = next((time_dim for time_dim in ['time', 'time1', 'time2'] if time_dim in dataset.dims), None)
+        return self.dim if self.dim in dataset.dims else None
+
+    def push(self, dataset):
+        """
+        Load the next chunk and reduce its complete bins/windows
+
+        :param dataset: xarray.Dataset, the next chunk along the aggregation dimension. A dataset without the
+            aggregation dimension is reduced at once and must be the only one pushed.
+        """
+        dim = self.get_dim(dataset)
+        if dim is None:
+            self.parts.append(self.aggregate(dataset.load()))
+            return
+        if dataset.sizes[dim] == 0:
+            return
+        dataset = dataset.load()
+        if self._carry is not None:
+            dataset = xarray.concat([self._carry, dataset], dim=dim, data_vars='minimal')
+        size = dataset.sizes[dim]
+        if self.resample:
+            # The last bin may be continued by the next chunk
+            bin_ids = pandas.Series(numpy.arange(size), index=dataset.indexes[dim]).groupby(
+                pandas.Grouper(freq=self.resample[dim], **self._get_origin_kwargs(dataset))).ngroup().to_numpy()
+            stop = int(numpy.flatnonzero(bin_ids == bin_ids[-1])[0])
+        else:
+            window = self.coarsen.get(dim, 1)
+            stop = size - size % window
+        if stop > 0:
+            self.parts.append(self.aggregate(dataset.isel({dim: slice(0, stop)})))
+        # Copy the remainder so that the chunk can be released
+        self._carry = dataset.isel({dim: slice(stop, None)}).copy(deep=True) if stop < size else None
+
+    def _get_origin_kwargs(self, dataset):
+        # Calendar frequencies (e.g. days, months) are anchored anyway
+        if not isinstance(pandas.tseries.frequencies.to_offset(self.resample[self.dim]), pandas.tseries.offsets.Tick):
+            return {}
+        if self.origin is None:
+            self.origin = pandas.Timestamp(dataset.indexes[self.dim][0]).normalize()
+        return {'origin': self.origin}
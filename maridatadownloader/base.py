@@ -1,9 +1,37 @@
+from maridatadownloader.scheduler import get_default_scheduler
+from maridatadownloader.transport import get_default_transport
+
+
 class DownloaderBase:
     """Downloader base class"""
     def __init__(self, downloader_type, **kwargs):
         self.downloader_type = downloader_type
         self.username = kwargs.get('username', None)
         self.password = kwargs.get('password', None)
+        self.encoding_policy = kwargs.get('encoding_policy', None)
+        self.scheduler = kwargs.get('scheduler', None) or get_default_scheduler()
+        self.transport = kwargs.get('transport', None) or get_default_transport()
+
+    def apply_encoding_policy(self, dataset):
+        """Apply the in-memory part of the encoding policy (see maridatadownloader.encoding.EncodingPolicy)"""
+        if self.encoding_policy is None:
+            return dataset
+        return self.encoding_policy.apply(dataset, *self._get_encoding_products())
 
     def download(self, **kwargs):
         raise NotImplementedError(".download() must be overridden.")
+
+    def save_dataset(self, dataset, file_out):
+        """Save dataset as NetCDF file using the file encoding of the encoding policy (if any)"""
+        encoding = None
+        if self.encoding_policy is not None:
+            encoding = self.encoding_policy.get_encoding(dataset, *self._get_encoding_products())
+            # Remove encoding keys inherited from the source which would conflict with the new encoding
+            dataset = dataset.copy()
+            for var in encoding:
+                for key in ['dtype', 'scale_factor', 'add_offset', '_FillValue', 'missing_value']:
+                    dataset[var].encoding.pop(key, None)
+        dataset.to_netcdf(file_out, encoding=encoding)
+
+    def _get_encoding_products(self):
+        return [getattr(self, 'product', None), getattr(self, 'platform', None)]
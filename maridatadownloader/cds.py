@@ -2,10 +2,10 @@ import io
 import logging
 
 import cdsapi
-import requests
 import xarray as xr
 
 from maridatadownloader.base import DownloaderBase
+from maridatadownloader.scheduler import TRANSIENT_HTTP_STATUS_CODES
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +21,9 @@ class DownloaderCdsApiERA5(DownloaderBase):
         self.platform = 'era5'
         self.dataset = None
         self.url = 'https://cds.climate.copernicus.eu/api/v2'
-        self.client = cdsapi.Client(url=self.url, key=f'{self.username}:{self.password}')
+        # The client stores the credentials on its session, thus it gets a dedicated (pooled) session
+        self.client = cdsapi.Client(url=self.url, key=f'{self.username}:{self.password}',
+                                    timeout=self.transport.read_timeout, session=self.transport.create_session())
 
     def download(self, settings=None, file_out=None, **kwargs):
         """
@@ -32,8 +34,9 @@ class DownloaderCdsApiERA5(DownloaderBase):
         """
         settings['product_type'] = 'reanalysis'
         settings['format'] = 'netcdf'
-        request = self.client.retrieve(name='reanalysis-era5-single-levels', request=settings)
-        r = requests.get(request.location)
+        request = self.scheduler.call(self.url, self.client.retrieve, name='reanalysis-era5-single-levels',
+                                      request=settings)
+        r = self.scheduler.call(request.location, self._get, request.location)
         if r.status_code == 200:
             logger.info('Download successful')
         nc_data = io.BytesIO(r.content)
@@ -45,9 +48,11 @@ class DownloaderCdsApiERA5(DownloaderBase):
         except NotImplementedError:
             pass
 
+        dataset = self.apply_encoding_policy(dataset)
+
         if file_out:
             logger.info(f"Save dataset to '{file_out}'")
-            dataset.to_netcdf(file_out)
+            self.save_dataset(dataset, file_out)
         return dataset
 
     def postprocessing(self, dataset, **kwargs):
@@ -56,3 +61,10 @@ class DownloaderCdsApiERA5(DownloaderBase):
         """
         dataset = dataset.reindex(latitude=list(reversed(dataset.latitude)))
         return dataset
+
+    def _get(self, url):
+        r = self.transport.get(url)
+        # Raise for transient server errors so that the request is retried by the scheduler
+        if r.status_code in TRANSIENT_HTTP_STATUS_CODES:
+            r.raise_for_status()
+        return r
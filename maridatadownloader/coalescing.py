@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from numbers import Real
+
+from numpy import datetime64
+from pandas import Timestamp
+
+from maridatadownloader.utils import get_start_and_end_time
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCoalescer:
+    """
+    Coalesce concurrent overlapping requests
+
+    The first request for a key (e.g. product, parameters and non-box selections) becomes the leader of a group and
+    waits `window` seconds for further requests. Requests with the same key whose box overlaps the box of the group
+    during this time extend the group box to the union of both. Requests arriving while the group is fetching join
+    the group if their box is contained in the union. A single fetch is issued for the union and every caller gets
+    its own slice of the result.
+    """
+    def __init__(self, window=0.05):
+        """
+        :param window: time in seconds the leader of a group waits for further requests before fetching
+        """
+        self.window = window
+        self.stats = {'requests': 0, 'fetches': 0}
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, key, box, fetch_func):
+        """
+        :param key: hashable key; only requests with the same key are coalesced
+        :param box: dict {dim: (start, stop)}
+        :param fetch_func: callable taking a box (dict {dim: slice}) and returning an xarray.Dataset/DataArray
+        :return: result of fetch_func for box
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            group = self._find_group(key, box)
+            is_leader = group is None
+            if is_leader:
+                group = _Group(box)
+                self._groups.setdefault(key, []).append(group)
+                self.stats['fetches'] += 1
+            group.n_requests += 1
+
+        if is_leader:
+            time.sleep(self.window)
+            with self._lock:
+                group.fetching = True
+                union_box = dict(group.box)
+            logger.debug(f"Fetch union of {group.n_requests} coalesced requests: {union_box}")
+            try:
+                group.result = fetch_func(_to_slices(union_box))
+            except Exception as err:
+                group.error = err
+            finally:
+                with self._lock:
+                    self._groups[key].remove(group)
+                    if not self._groups[key]:
+                        del self._groups[key]
+                group.done.set()
+        else:
+            group.done.wait()
+
+        if group.error is not None:
+            raise group.error
+        return group.result.sel(**_to_slices(box))
+
+    def _find_group(self, key, box):
+        for group in self._groups.get(key, []):
+            if group.fetching:
+                if group.contains(box):
+                    return group
+            elif group.overlaps(box):
+                group.extend(box)
+                return group
+        return None
+
+
+class _Group:
+    def __init__(self, box):
+        self.box = dict(box)
+        self.n_requests = 0
+        self.fetching = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def contains(self, box):
+        return all(self.box[dim][0] <= start and stop <= self.box[dim][1] for dim, (start, stop) in box.items())
+
+    def extend(self, box):
+        for dim, (start, stop) in box.items():
+            self.box[dim] = (min(self.box[dim][0], start), max(self.box[dim][1], stop))
+
+    def overlaps(self, box):
+        return all(start <= self.box[dim][1] and self.box[dim][0] <= stop for dim, (start, stop) in box.items())
+
+
+def get_coalescing_box(coord_dict):
+    """
+    Split a sel coord_dict into a box (slices) and the remaining (scalar) indexers
+
+    :return: 2-tuple (box, scalars) with box as dict {dim: (start, stop)} or None if the request cannot be coalesced
+    """
+    box = {}
+    scalars = {}
+    for dim, indexer in coord_dict.items():
+        if isinstance(indexer, slice):
+            if indexer.start is None or indexer.stop is None or indexer.step is not None:
+                return None
+            if isinstance(indexer.start, (str, datetime, datetime64)):
+                try:
+                    start, stop = get_start_and_end_time(indexer)
+                except ValueError:
+                    # E.g. partial datetime strings which are interpreted differently by xarray
+                    return None
+                start, stop = _to_naive(start), _to_naive(stop)
+            elif isinstance(indexer.start, Real) and isinstance(indexer.stop, Real):
+                start, stop = float(indexer.start), float(indexer.stop)
+            else:
+                return None
+            if start > stop:
+                # E.g. descending coordinates
+                return None
+            box[dim] = (start, stop)
+        elif isinstance(indexer, (str, Real, datetime)):
+            scalars[dim] = indexer
+        else:
+            return None
+    if not box:
+        return None
+    return box, scalars
+
+
+def _to_naive(datetime_obj):
+    timestamp = Timestamp(datetime_obj)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp
+
+
+def _to_slices(box):
+    return {dim: slice(start, stop) for dim, (start, stop) in box.items()}
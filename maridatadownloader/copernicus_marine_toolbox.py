@@ -1,7 +1,16 @@
 import logging
+import os
+import tempfile
+import uuid
 
 import copernicusmarine
+import numpy as np
+import pandas
+import xarray
 
+from maridatadownloader.prefetch import prefetchable
+from maridatadownloader.scheduler import get_default_scheduler
+from maridatadownloader.utils import get_sel_dict_orthogonal, get_start_and_end_time
 from maridatadownloader.xarray import DownloaderXarray
 
 logger = logging.getLogger(__name__)
@@ -14,12 +23,23 @@ class DownloaderCopernicusMarineToolboxApi(DownloaderXarray):
     The download method provides a convenient way to download data using lazy-loading. For more details check the
     documentation of the base class `DownloaderXarray` and the references below.
 
+    The Copernicus Marine data store publishes each product in two ARCO layouts: chunked for time series
+    ('arco-time-series') and chunked for maps ('arco-geo-series'). By default, the download method selects the
+    layout whose chunking suits the shape of the request (see `select_service`). Large extractions can also be
+    processed server-side by `copernicusmarine.subset` and read from a local file (see argument `use_subset`). The
+    result is the same whichever path is used.
+
     References:
         - https://pypi.org/project/copernicusmarine/
         - https://help.marine.copernicus.eu/en/articles/7949409-copernicus-marine-toolbox-introduction
         - https://help.marine.copernicus.eu/en/articles/8612591-switching-from-current-to-new-services
     """
     # ToDo: make DownloaderXarray or parts of it a Mixin?
+    SERVICE_GEO_SERIES = 'arco-geo-series'
+    SERVICE_TIME_SERIES = 'arco-time-series'
+    # Host name used by the fetch scheduler to limit concurrent requests
+    SCHEDULER_HOST = 'marine.copernicus.eu'
+
     def __init__(self, username, password, **kwargs):
         self.downloader_type = 'cmtapi'
         self.platform = 'cmems'
@@ -28,10 +48,15 @@ class DownloaderCopernicusMarineToolboxApi(DownloaderXarray):
         self.product = kwargs.get('product')
         self.product_type = kwargs.get('product_type')
         self.dataset = None
-        if 'chunks' in kwargs:
-            self.chunks = kwargs['chunks']
-        else:
-            self.chunks = None
+        # Opened datasets per ARCO service (None: service selected by the toolbox)
+        self.datasets = {}
+        self.service = None
+        self.encoding_policy = kwargs.get('encoding_policy', None)
+        self.scheduler = kwargs.get('scheduler', None) or get_default_scheduler()
+        self._init_options(**kwargs)
+        # Minimum estimated size of a request for which copernicusmarine.subset is used with use_subset='auto'
+        self.subset_min_bytes = kwargs.get('subset_min_bytes', 2 * 1024 ** 3)
+        self.subset_directory = kwargs.get('subset_directory', tempfile.gettempdir())
         self.client = copernicusmarine.login(username=username, password=password, force_overwrite=True)
         if self.product:
             self.open_dataset()
@@ -40,6 +65,7 @@ class DownloaderCopernicusMarineToolboxApi(DownloaderXarray):
         # FIXME: this is inconsistent with the parent class at the moment
         return None
 
+    @prefetchable
     def download(self, parameters=None, sel_dict=None, isel_dict=None, file_out=None, interpolate=False, **kwargs):
         """
         :param parameters: str or list
@@ -57,6 +83,13 @@ class DownloaderCopernicusMarineToolboxApi(DownloaderXarray):
         :param kwargs:
             Additional keyword arguments are passed to the corresponding method sel, isel or interp.
             For details on which arguments can be used check the references below.
+            Special keyword arguments:
+             - service: 'auto' (default), 'arco-geo-series', 'arco-time-series' or None (selected by the toolbox)
+             - use_subset: False (default), True or 'auto'. If True, the data is extracted server-side using
+               copernicusmarine.subset and read from a local NetCDF file, which is deleted once the result has
+               been loaded. Hence, the result is loaded into memory instead of being returned lazily. 'auto' uses
+               the subset path if the estimated size of the request exceeds self.subset_min_bytes.
+             - derived: str or list, e.g. ['current_speed', 'current_direction'] (see maridatadownloader.derived)
         :return: xarray.Dataset
 
         References:
@@ -66,44 +99,194 @@ class DownloaderCopernicusMarineToolboxApi(DownloaderXarray):
          - https://docs.xarray.dev/en/latest/user-guide/interpolation.html
          - https://docs.xarray.dev/en/latest/generated/xarray.Dataset.interp.html
         """
-        product = kwargs.get('product')
+        aggregation_kwargs = self._pop_aggregation_kwargs(kwargs)
+        service = kwargs.pop('service', 'auto')
+        use_subset = kwargs.pop('use_subset', False)
+        product = kwargs.pop('product', None)
         if product:
-            self.product = product
-            self.open_dataset()
+            self.set_product(product)
         elif self.product is None:
             msg = "No product has been set yet!"
             logger.error(msg)
             raise ValueError(msg)
 
+        derived = self._pop_derived(kwargs)
+        requested_parameters = parameters
+        parameters = self._get_derived_parameters(parameters, derived)
         coord_dict, subsetting_method = self._prepare_download(sel_dict, isel_dict, interpolate)
 
-        try:
-            dataset = self.preprocessing(self.dataset, parameters=parameters, coord_dict=coord_dict)
-        except NotImplementedError:
-            dataset = self.dataset
+        if service == 'auto':
+            service = self.select_service(parameters, coord_dict, subsetting_method)
+        if service != self.service:
+            self.open_dataset(service=service)
 
-        dataset_sub = self._apply_subsetting(dataset, parameters, coord_dict, subsetting_method, **kwargs)
+        if subsetting_method != 'isel' and use_subset == 'auto':
+            use_subset = self._estimate_nbytes(parameters, coord_dict) > self.subset_min_bytes
+        if subsetting_method != 'isel' and use_subset:
+            # The subset file is only needed until the result has been loaded
+            subset_file = self._subset_to_file(parameters, coord_dict)
+            try:
+                with xarray.open_dataset(subset_file, decode_coords="all", chunks=self.chunks) as source:
+                    dataset_sub = self._download_from_source(source, parameters, coord_dict, subsetting_method,
+                                                             derived, requested_parameters, aggregation_kwargs,
+                                                             **kwargs).load()
+            finally:
+                os.remove(subset_file)
+        else:
+            dataset_sub = self._download_from_source(self.dataset, parameters, coord_dict, subsetting_method, derived,
+                                                     requested_parameters, aggregation_kwargs, **kwargs)
 
-        try:
-            dataset_sub = self.postprocessing(dataset_sub)
-        except NotImplementedError:
-            pass
+        dataset_sub = self.apply_encoding_policy(dataset_sub)
 
         if file_out:
             logger.info(f"Save dataset to '{file_out}'")
-            dataset_sub.to_netcdf(file_out)
+            self.save_dataset(dataset_sub, file_out)
 
         return dataset_sub
 
-    def open_dataset(self, filename_or_obj=None):
-        try:
-            self.dataset = copernicusmarine.open_dataset(dataset_id=self.product)
-        except Exception as err:
-            raise err
+    def open_dataset(self, filename_or_obj=None, service=None):
+        """
+        :param filename_or_obj: not used
+        :param service: ARCO service, e.g. 'arco-geo-series' or 'arco-time-series'. If None, the service is
+            selected by the toolbox.
+        """
+        if service not in self.datasets:
+            try:
+                self.datasets[service] = self.scheduler.call(self.SCHEDULER_HOST, copernicusmarine.open_dataset,
+                                                             dataset_id=self.product, service=service)
+            except Exception as err:
+                raise err
+        self.dataset = self.datasets[service]
+        self.service = service
+
+    def select_service(self, parameters=None, coord_dict=None, subsetting_method='sel'):
+        """
+        Select the ARCO layout whose chunking suits the request: 'arco-time-series' if the request spans more time
+        steps than spatial grid points (e.g. long time series at a few points), otherwise 'arco-geo-series' (e.g.
+        large maps at a few time steps). For vectorized indexing the orthogonal bounding box is used.
+
+        :return: str
+        """
+        if subsetting_method == 'isel' or self.dataset is None:
+            return self.service
+        sizes = self._get_selection_sizes(parameters, coord_dict)
+        n_time = sizes.get('time', 1)
+        n_space = sizes.get('latitude', 1) * sizes.get('longitude', 1)
+        service = self.SERVICE_TIME_SERIES if n_time > n_space else self.SERVICE_GEO_SERIES
+        logger.debug(f"Selected service '{service}' ({n_time} time steps, {n_space} grid points)")
+        return service
 
     def set_product(self, product):
         self.product = product
-        self.open_dataset()
+        self.datasets = {}
+        self.open_dataset(service=self.service)
 
     def set_product_type(self, product_type):
         self.product_type = product_type
+
+    def _download_from_source(self, source, parameters=None, coord_dict=None, subsetting_method=None, derived=None,
+                              requested_parameters=None, aggregation_kwargs=None, **kwargs):
+        """Apply the sub-setting, derived variables and aggregation to source (ARCO dataset or subset file)"""
+        try:
+            dataset = self.preprocessing(source, parameters=parameters, coord_dict=coord_dict)
+        except NotImplementedError:
+            dataset = source
+
+        dataset = self._prefetch_orthogonal(dataset, parameters, coord_dict, subsetting_method, kwargs.get('method'))
+        if aggregation_kwargs or source is not self.dataset:
+            # Aggregated selections are kept lazy and subset files are private to a single request, so only plain
+            # requests to the ARCO dataset are coalesced
+            dataset_sub = self._apply_subsetting(dataset, parameters, coord_dict, subsetting_method, **kwargs)
+        else:
+            dataset_sub = self._apply_subsetting_coalesced(dataset, parameters, coord_dict, subsetting_method,
+                                                           **kwargs)
+        dataset_sub = self._apply_derived(dataset_sub, derived, requested_parameters)
+
+        try:
+            dataset_sub = self.postprocessing(dataset_sub)
+        except NotImplementedError:
+            pass
+
+        if aggregation_kwargs:
+            dataset_sub = self._apply_aggregation(dataset_sub, **aggregation_kwargs)
+        return dataset_sub
+
+    def _estimate_nbytes(self, parameters=None, coord_dict=None):
+        sizes = self._get_selection_sizes(parameters, coord_dict)
+        dataset = self._select_parameters(self.dataset, parameters)
+        nbytes = 0
+        for var in dataset.data_vars:
+            nbytes += dataset[var].dtype.itemsize * int(np.prod([sizes.get(dim, dataset.sizes[dim])
+                                                                  for dim in dataset[var].dims]))
+        return nbytes
+
+    def _get_selection_sizes(self, parameters=None, coord_dict=None):
+        """Number of selected coordinate values per dimension (orthogonal bounding box for vectorized indexing)"""
+        dataset = self._select_parameters(self.dataset, parameters)
+        sizes = dict(dataset.sizes)
+        if not coord_dict:
+            return sizes
+        for dim, indexer in get_sel_dict_orthogonal(coord_dict).items():
+            if dim not in dataset.dims:
+                continue
+            if isinstance(indexer, slice):
+                sizes[dim] = dataset[dim].sel({dim: indexer}).size
+            elif isinstance(indexer, (list, np.ndarray)):
+                sizes[dim] = len(indexer)
+            else:
+                sizes[dim] = 1
+        return sizes
+
+    @staticmethod
+    def _select_parameters(dataset, parameters=None):
+        if not parameters:
+            return dataset
+        return dataset[[parameters] if isinstance(parameters, str) else parameters]
+
+    def _subset_to_file(self, parameters=None, coord_dict=None):
+        """
+        Extract the (buffered) bounding box of the request server-side using copernicusmarine.subset into a local
+        NetCDF file. The coordinates selection method 'outside' guarantees that the bounding box fully covers the
+        request, so the subsequent sub-setting yields the same result as with the ARCO datasets.
+
+        :return: path of the NetCDF file. The caller is responsible for deleting it.
+        """
+        subset_kwargs = {}
+        if parameters:
+            subset_kwargs['variables'] = [parameters] if isinstance(parameters, str) else list(parameters)
+        sel_dict_orthogonal = get_sel_dict_orthogonal(coord_dict) if coord_dict else {}
+        for dim, (key_min, key_max) in {'longitude': ('minimum_longitude', 'maximum_longitude'),
+                                        'latitude': ('minimum_latitude', 'maximum_latitude'),
+                                        'depth': ('minimum_depth', 'maximum_depth')}.items():
+            indexer = sel_dict_orthogonal.get(dim)
+            if indexer is None:
+                continue
+            if isinstance(indexer, slice):
+                subset_kwargs[key_min], subset_kwargs[key_max] = [None if value is None else float(value)
+                                                                  for value in (indexer.start, indexer.stop)]
+            elif isinstance(indexer, (list, np.ndarray, xarray.DataArray)):
+                subset_kwargs[key_min], subset_kwargs[key_max] = float(np.min(indexer)), float(np.max(indexer))
+            else:
+                subset_kwargs[key_min] = subset_kwargs[key_max] = float(indexer)
+        if sel_dict_orthogonal.get('time') is not None:
+            time_start, time_end = get_start_and_end_time(sel_dict_orthogonal['time'])
+            subset_kwargs['start_datetime'], subset_kwargs['end_datetime'] = [
+                self._to_datetime(value) for value in (time_start, time_end)]
+        subset_kwargs = {key: value for key, value in subset_kwargs.items() if value is not None}
+
+        output_filename = f"{self.product}_{uuid.uuid4().hex}.nc"
+        logger.info(f"Extract subset to '{os.path.join(self.subset_directory, output_filename)}'")
+        response = self.scheduler.call(self.SCHEDULER_HOST, copernicusmarine.subset, dataset_id=self.product,
+                                       service=self.service, coordinates_selection_method='outside',
+                                       output_filename=output_filename, output_directory=self.subset_directory,
+                                       **subset_kwargs)
+        return response.file_path
+
+    @staticmethod
+    def _to_datetime(value):
+        """Convert a time bound (e.g. a 0-d DataArray, numpy.datetime64 or str) into a datetime for the toolbox"""
+        if value is None:
+            return None
+        if isinstance(value, xarray.DataArray):
+            value = value.values
+        return pandas.Timestamp(value).to_pydatetime()
@@ -0,0 +1,101 @@
+"""
+Registry of derived variables
+
+A derived variable (e.g. wind speed) is computed from component variables (e.g. the u and v components of the
+wind). Since the names of the components differ between products, every derived variable defines alternative sets
+of component names. The first set which is available in a dataset is used.
+
+Custom derived variables can be added with `register_derived_variable`.
+"""
+import numpy as np
+
+# Standard gravity in m s-2
+GRAVITY = 9.80665
+
+_derived_variables = {}
+
+
+def get_components(name, variables):
+    """
+    :param name: name of the derived variable
+    :param variables: names of the variables available in the dataset
+    :return: tuple of component names
+    :raises ValueError: if the derived variable is unknown or none of its component sets is available
+    """
+    if name not in _derived_variables:
+        raise ValueError(f"Unknown derived variable '{name}'")
+    variables = set(variables)
+    for components in _derived_variables[name]['components']:
+        if all(component in variables for component in components):
+            return components
+    raise ValueError(f"None of the component sets {_derived_variables[name]['components']} of the derived "
+                     f"variable '{name}' is available")
+
+
+def compute_derived_variable(name, dataset):
+    """
+    :param name: name of the derived variable
+    :param dataset: xarray.Dataset including the components
+    :return: xarray.DataArray
+    """
+    derived_variable = _derived_variables[name]
+    components = get_components(name, dataset.data_vars)
+    dataarray = derived_variable['func'](*[dataset[component] for component in components])
+    dataarray.attrs = dict(derived_variable['attrs'])
+    return dataarray.rename(name)
+
+
+def list_derived_variables():
+    """:return: sorted list of the names of the registered derived variables"""
+    return sorted(_derived_variables)
+
+
+def register_derived_variable(name, components, func, attrs=None, overwrite=False):
+    """
+    :param name: name of the derived variable
+    :param components: list of alternative tuples of component names, e.g. [('uo', 'vo'), ('utotal', 'vtotal')]
+    :param func: callable taking the components (xarray.DataArray, in the order of the tuple) and returning an
+        xarray.DataArray. It must only use element-wise operations so that it can be applied chunk by chunk.
+    :param attrs: attributes of the derived variable, e.g. {'units': 'm s-1'}
+    :param overwrite: replace an already registered derived variable
+    """
+    if name in _derived_variables and not overwrite:
+        raise ValueError(f"Derived variable '{name}' is already registered")
+    _derived_variables[name] = {'components': [tuple(component_set) for component_set in components], 'func': func,
+                                'attrs': attrs or {}}
+
+
+def _direction_from(u, v):
+    # Meteorological convention: direction the flow is coming from, clockwise from north
+    return np.degrees(np.arctan2(-u, -v)) % 360
+
+
+def _direction_to(u, v):
+    # Oceanographic convention: direction the flow is going to, clockwise from north
+    return np.degrees(np.arctan2(u, v)) % 360
+
+
+def _speed(u, v):
+    return np.hypot(u, v)
+
+
+def _wave_steepness(significant_height, peak_period):
+    # Ratio of the significant wave height to the deep water wave length at the peak period
+    return (2 * np.pi * significant_height / (GRAVITY * peak_period ** 2)).where(peak_period > 0)
+
+
+_WIND_COMPONENTS = [('u-component_of_wind_height_above_ground', 'v-component_of_wind_height_above_ground'),
+                    ('u10', 'v10'), ('u', 'v')]
+_CURRENT_COMPONENTS = [('uo', 'vo'), ('utotal', 'vtotal')]
+_WAVE_COMPONENTS = [('VHM0', 'VTPK'), ('swh', 'pp1d')]
+
+register_derived_variable('wind_speed', _WIND_COMPONENTS, _speed,
+                          {'units': 'm s-1', 'long_name': 'Wind speed'})
+register_derived_variable('wind_direction', _WIND_COMPONENTS, _direction_from,
+                          {'units': 'degree', 'long_name': 'Wind direction (coming from, clockwise from north)'})
+register_derived_variable('current_speed', _CURRENT_COMPONENTS, _speed,
+                          {'units': 'm s-1', 'long_name': 'Sea water speed'})
+register_derived_variable('current_direction', _CURRENT_COMPONENTS, _direction_to,
+                          {'units': 'degree', 'long_name': 'Sea water direction (going to, clockwise from north)'})
+register_derived_variable('wave_steepness', _WAVE_COMPONENTS, _wave_steepness,
+                          {'units': '1', 'long_name': 'Wave steepness (significant wave height / peak wave length)'})
@@ -0,0 +1,155 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EncodingPolicy:
+    """
+    Per-product and per-variable dtype/encoding policy to shrink downloaded datasets
+
+    Rules are defined per product (or platform) and variable. The wildcard '*' can be used for both. A rule is either
+    'float32' (downcast floating point variables) or a dict defining scale-offset quantisation to an integer type
+    with a declared precision, e.g. {'dtype': 'int16', 'precision': 0.01}.
+
+    In memory, all variables with a rule are stored as float32. Quantised variables are additionally rounded to their
+    declared precision so that the in-memory dataset matches the content of the written file. The integer packing
+    (scale_factor/add_offset) is applied when writing NetCDF files (see `get_encoding`).
+
+    Example:
+        policy = EncodingPolicy({
+            'cmems_mod_glo_wav_anfc_0.083deg_PT3H-i': {'VHM0': {'dtype': 'int16', 'precision': 0.01}},
+            'gfs': {'Temperature_surface': {'dtype': 'int16', 'precision': 0.01}},
+            '*': {'*': 'float32'}
+        })
+        gfs = DownloaderFactory.get_downloader('xarray', 'gfs', encoding_policy=policy)
+    """
+    def __init__(self, rules):
+        """
+        :param rules: dict with product (or platform) as key and a dict {variable: rule} as value
+        """
+        self.rules = rules
+        for product_rules in rules.values():
+            for variable, rule in product_rules.items():
+                self._validate_rule(variable, rule)
+
+    def apply(self, dataset, *products):
+        """
+        Apply the in-memory part of the policy
+
+        :param dataset: xarray.Dataset
+        :param products: product and/or platform names used to look up the rules (in descending priority)
+        :return: xarray.Dataset
+        """
+        dataset = dataset.copy()
+        for var in dataset.data_vars:
+            rule = self.get_rule(var, *products)
+            if rule is None or not np.issubdtype(dataset[var].dtype, np.floating):
+                continue
+            attrs = dataset[var].attrs
+            if isinstance(rule, dict):
+                precision = rule['precision']
+                dataset[var] = (np.round(dataset[var] / precision) * precision).astype('float32')
+            else:
+                dataset[var] = dataset[var].astype('float32')
+            dataset[var].attrs = attrs
+        return dataset
+
+    def get_encoding(self, dataset, *products):
+        """
+        :param dataset: xarray.Dataset
+        :param products: product and/or platform names used to look up the rules (in descending priority)
+        :return: dict which can be passed as encoding to xarray.Dataset.to_netcdf
+        """
+        encoding = {}
+        for var in dataset.data_vars:
+            rule = self.get_rule(var, *products)
+            if rule is None or not np.issubdtype(dataset[var].dtype, np.floating):
+                continue
+            if isinstance(rule, dict):
+                var_encoding = self._get_quantisation_encoding(dataset[var], rule)
+                if var_encoding is None:
+                    var_encoding = {'dtype': 'float32'}
+            else:
+                var_encoding = {'dtype': 'float32'}
+            encoding[var] = var_encoding
+        return encoding
+
+    def get_rule(self, variable, *products):
+        """
+        :return: rule for variable or None if no rule is defined
+        """
+        for product in [product for product in products if product] + ['*']:
+            product_rules = self.rules.get(product, {})
+            if variable in product_rules:
+                return product_rules[variable]
+            if '*' in product_rules:
+                return product_rules['*']
+        return None
+
+    def max_quantisation_error(self, dataset, *products):
+        """
+        Report the maximum absolute error introduced by the policy (in-memory and file encoding) for each variable
+
+        :param dataset: xarray.Dataset with the original (unmodified) values
+        :param products: product and/or platform names used to look up the rules (in descending priority)
+        :return: dict with variable as key and a dict with the maximum error and, for quantised variables, the
+            declared precision as value
+        """
+        errors = {}
+        encoding = self.get_encoding(dataset, *products)
+        for var, var_encoding in encoding.items():
+            original = np.asarray(dataset[var].values, dtype='float64')
+            if 'scale_factor' in var_encoding:
+                # add_offset is a multiple of scale_factor, so packing doesn't add an error to the in-memory rounding
+                scale_factor = var_encoding['scale_factor']
+                decoded = np.round(original / scale_factor) * scale_factor
+            else:
+                decoded = original
+            decoded = decoded.astype('float32').astype('float64')
+            error = np.abs(decoded - original)
+            max_error = float(np.nanmax(error)) if np.any(np.isfinite(error)) else 0.
+            errors[var] = {'max_error': max_error}
+            rule = self.get_rule(var, *products)
+            if isinstance(rule, dict):
+                errors[var]['precision'] = rule['precision']
+        return errors
+
+    @staticmethod
+    def _get_quantisation_encoding(dataarray, rule):
+        dtype = np.dtype(rule['dtype'])
+        precision = rule['precision']
+        info = np.iinfo(dtype)
+        vmin = float(dataarray.min(skipna=True).values)
+        vmax = float(dataarray.max(skipna=True).values)
+        if not (np.isfinite(vmin) and np.isfinite(vmax)):
+            return None
+        # The smallest integer is reserved for the fill value
+        n_values = int(info.max) - int(info.min)
+        if (vmax - vmin) / precision > n_values - 2:
+            logger.warning(f"Value range of '{dataarray.name}' ({vmin}, {vmax}) cannot be represented with precision "
+                           f"{precision} and dtype '{dtype}'. Fall back to float32.")
+            return None
+        # Center the value range on the integer range. The offset is a multiple of the precision so that the values
+        # rounded in memory (see apply) are represented exactly.
+        add_offset = (vmin + vmax) / 2. - (int(info.max) + int(info.min) + 1) / 2. * precision
+        add_offset = round(add_offset / precision) * precision
+        return {
+            'dtype': dtype.name,
+            'scale_factor': precision,
+            'add_offset': add_offset,
+            '_FillValue': info.min
+        }
+
+    @staticmethod
+    def _validate_rule(variable, rule):
+        if rule == 'float32':
+            return
+        if isinstance(rule, dict) and 'dtype' in rule and 'precision' in rule:
+            if not np.issubdtype(np.dtype(rule['dtype']), np.integer):
+                raise ValueError(f"Quantisation dtype for '{variable}' must be an integer type")
+            if rule['precision'] <= 0:
+                raise ValueError(f"Precision for '{variable}' must be positive")
+            return
+        raise ValueError(f"Invalid encoding rule for '{variable}': {rule}")
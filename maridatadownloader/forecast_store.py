@@ -0,0 +1,180 @@
+import logging
+import os
+import time as time_module
+from datetime import datetime, timedelta, timezone
+
+import xarray
+
+from maridatadownloader.xarray import DownloaderXarrayGFS
+
+logger = logging.getLogger(__name__)
+
+
+class GFSForecastStore:
+    """
+    Rolling local store for GFS forecasts
+
+    For every new model cycle (00/06/12/18 UTC) `refresh` downloads only the forecast of this reference time for the
+    configured regions and parameters and drops the cycles which have been superseded. Forecast queries are then
+    served from the local store (in memory and, optionally, as NetCDF files in `directory`) via `query`.
+
+    Example:
+        regions = {'north_sea': {'latitude': slice(50, 60), 'longitude': slice(-5, 10)}}
+        store = GFSForecastStore(regions, parameters=['Temperature_surface'], directory='gfs_store')
+        store.refresh()
+        store.query(sel_dict={'time': slice('2023-11-24T12:00:00', '2023-11-25T12:00:00')})
+    """
+    def __init__(self, regions, parameters, directory=None, keep_cycles=1, availability_delay=timedelta(hours=5),
+                 sel_dict=None, downloader=None):
+        """
+        :param regions: dict with region name as key and sel_dict (latitude/longitude slices) as value
+        :param parameters: str or list
+        :param directory: directory for persisting the store as NetCDF files. Nothing is persisted if None.
+        :param keep_cycles: number of most recent model cycles to keep
+        :param availability_delay: time after the model cycle (reference time) after which the forecast is expected
+            to be available on the server
+        :param sel_dict: additional coordinate selection applied to all regions, e.g. {'height_above_ground': 10}
+        :param downloader: DownloaderXarrayGFS object. A new one is created if None.
+        """
+        assert keep_cycles >= 1, "keep_cycles must be at least 1"
+        self.regions = regions
+        self.parameters = parameters
+        self.directory = directory
+        self.keep_cycles = keep_cycles
+        self.availability_delay = availability_delay
+        self.sel_dict = sel_dict if sel_dict else {}
+        self.downloader = downloader if downloader else DownloaderXarrayGFS()
+        # Reference time (datetime.datetime) -> {region name: xarray.Dataset}
+        self.cycles = {}
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_directory()
+
+    @property
+    def latest_cycle(self):
+        if not self.cycles:
+            return None
+        return max(self.cycles)
+
+    def get_expected_cycle(self, now=None):
+        """
+        :param now: datetime.datetime, defaults to the current time
+        :return: reference time of the most recent model cycle which is expected to be available
+        """
+        if now is None:
+            now = datetime.now(timezone.utc)
+        now = now.astimezone(timezone.utc) - self.availability_delay
+        cycles = [cycle for cycle in self.downloader.model_cycles if cycle <= now.time()]
+        return datetime.combine(now.date(), max(cycles), tzinfo=timezone.utc)
+
+    def query(self, region=None, parameters=None, sel_dict=None, interpolate=False, **kwargs):
+        """
+        Serve a forecast request from the latest model cycle in the store
+
+        :param region: name of the region. If None, the first region containing the latitude/longitude
+            selection is used.
+        :param parameters: str or list, defaults to all parameters of the store
+        :param sel_dict: dict, see DownloaderXarray.download
+        :param interpolate: bool, see DownloaderXarray.download
+        :param kwargs: passed to the corresponding xarray method (sel or interp)
+        :return: xarray.Dataset
+        """
+        if self.latest_cycle is None:
+            raise ValueError("Forecast store is empty. Call .refresh() first.")
+        if region is None:
+            region = self._find_region(sel_dict)
+        dataset = self.cycles[self.latest_cycle][region]
+        coord_dict, subsetting_method = self.downloader._prepare_download(sel_dict, interpolate=interpolate)
+        return self.downloader._apply_subsetting(dataset, parameters, coord_dict, subsetting_method, **kwargs)
+
+    def refresh(self, now=None):
+        """
+        Download the most recent model cycle if it is not in the store yet and drop superseded cycles
+
+        :return: True if a new model cycle has been added, otherwise False
+        """
+        reftime = self.get_expected_cycle(now)
+        if reftime in self.cycles:
+            logger.info(f"GFS model cycle {reftime:%Y-%m-%d %H:%M} is up-to-date")
+            return False
+
+        url = self.downloader._get_url_model_cycle(reftime)
+        logger.info(f"Download GFS model cycle {reftime:%Y-%m-%d %H:%M} from '{url}'")
+        datasets = {}
+        try:
+            self.downloader.set_filename_or_obj(url)
+            for region, region_sel_dict in self.regions.items():
+                sel_dict = {**self.sel_dict, **region_sel_dict}
+                datasets[region] = self.downloader.download(parameters=self.parameters, sel_dict=sel_dict).load()
+        except Exception as err:
+            logger.warning(f"Could not download GFS model cycle {reftime:%Y-%m-%d %H:%M}: {err}")
+            return False
+        finally:
+            # Reset to default forecast dataset so the downloader can be used as usual
+            self.downloader.set_filename_or_obj()
+
+        if self.directory:
+            for region, dataset in datasets.items():
+                dataset.to_netcdf(self._get_file_path(reftime, region))
+        self.cycles[reftime] = datasets
+        self._drop_superseded_cycles()
+        return True
+
+    def run_forever(self, interval=600):
+        """Call refresh every `interval` seconds"""
+        while True:
+            self.refresh()
+            time_module.sleep(interval)
+
+    def _drop_superseded_cycles(self):
+        for reftime in sorted(self.cycles)[:-self.keep_cycles]:
+            logger.info(f"Drop superseded GFS model cycle {reftime:%Y-%m-%d %H:%M}")
+            for region, dataset in self.cycles.pop(reftime).items():
+                dataset.close()
+                if self.directory:
+                    file_path = self._get_file_path(reftime, region)
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+
+    def _find_region(self, sel_dict):
+        if len(self.regions) == 1 or not sel_dict:
+            return next(iter(self.regions))
+        for region, region_sel_dict in self.regions.items():
+            if all(_contains(region_sel_dict.get(dim), sel_dict.get(dim)) for dim in ['latitude', 'longitude']):
+                return region
+        raise ValueError("No region of the forecast store contains the requested latitude/longitude")
+
+    def _get_file_path(self, reftime, region):
+        return os.path.join(self.directory, f"gfs_{reftime:%Y%m%d%H}_{region}.nc")
+
+    def _load_directory(self):
+        for file_name in sorted(os.listdir(self.directory)):
+            if not (file_name.startswith('gfs_') and file_name.endswith('.nc')):
+                continue
+            cycle_str, region = file_name[len('gfs_'):-len('.nc')].split('_', 1)
+            if region not in self.regions:
+                continue
+            reftime = datetime.strptime(cycle_str, '%Y%m%d%H').replace(tzinfo=timezone.utc)
+            dataset = xarray.load_dataset(os.path.join(self.directory, file_name))
+            self.cycles.setdefault(reftime, {})[region] = dataset
+        # Only use cycles which are complete
+        for reftime in list(self.cycles):
+            if set(self.cycles[reftime]) != set(self.regions):
+                del self.cycles[reftime]
+        self._drop_superseded_cycles()
+
+
+def _contains(region_slice, indexer):
+    if indexer is None:
+        return True
+    if region_slice is None:
+        return False
+    if isinstance(indexer, slice):
+        values = [indexer.start, indexer.stop]
+    elif isinstance(indexer, xarray.DataArray):
+        values = [indexer.min().item(), indexer.max().item()]
+    elif isinstance(indexer, (list, tuple)):
+        values = [min(indexer), max(indexer)]
+    else:
+        values = [indexer]
+    return all(value is None or region_slice.start <= value <= region_slice.stop for value in values)
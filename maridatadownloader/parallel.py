@@ -0,0 +1,134 @@
+"""
+Parallel interpolation along trajectories
+
+The sub-cube is loaded into shared memory once. The trajectory points are split into contiguous chunks which are
+interpolated by a pool of worker processes. The workers attach to the shared memory blocks, i.e. the data variables
+of the sub-cube are neither pickled nor copied per worker. Only the indexers of a chunk and the interpolated values
+are transferred between the processes.
+
+Note that on platforms using the 'spawn' start method (Windows, macOS) the calling script must be guarded by
+`if __name__ == '__main__':`.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy
+import xarray
+
+from maridatadownloader.utils import get_isel_dict_enclosing
+
+logger = logging.getLogger(__name__)
+
+# Shared memory blocks attached by a worker process. They are kept open until the worker process exits because the
+# interpolated datasets may still reference them while being returned.
+_attached_blocks = {}
+
+
+def interp_parallel(dataset, coord_dict, n_workers, min_chunk_size=1000, **kwargs):
+    """
+    Equivalent of dataset.interp(**coord_dict, **kwargs) using n_workers processes
+
+    The vectorized indexers (xarray.DataArray) must share a single dimension, e.g. 'trajectory', along which the
+    points are split. Otherwise, or if there are too few points, the interpolation is done in the calling process.
+    The bounding box of the indexers extended to the enclosing grid nodes (see get_isel_dict_enclosing) is loaded into
+    memory.
+
+    :param dataset: xarray.Dataset or xarray.DataArray
+    :param coord_dict: dict of indexers
+    :param n_workers: number of worker processes
+    :param min_chunk_size: minimum number of points per chunk
+    :param kwargs: passed to interp, e.g. method
+    :return: xarray.Dataset or xarray.DataArray with the points in the original order
+    """
+    dim = _get_vectorized_dim(coord_dict)
+    n_points = n_chunks = 0
+    if dim is not None and n_workers:
+        n_points = next(indexer.sizes[dim] for indexer in coord_dict.values() if isinstance(indexer, xarray.DataArray))
+        n_chunks = min(n_workers, n_points // min_chunk_size)
+    if n_chunks < 2:
+        return dataset.interp(**coord_dict, **kwargs)
+
+    name = None
+    if isinstance(dataset, xarray.DataArray):
+        name = dataset.name if dataset.name is not None else '__values__'
+        dataset = dataset.to_dataset(name=name)
+    dataset = _reduce_to_bbox(dataset, coord_dict, kwargs.get('method')).compute()
+
+    boundaries = numpy.linspace(0, n_points, n_chunks + 1).astype(int)
+    logger.info(f"Interpolate {n_points} points in {n_chunks} chunks using {n_workers} processes")
+
+    blocks = []
+    try:
+        spec = _share_dataset(dataset, blocks)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = []
+            for start, stop in zip(boundaries[:-1], boundaries[1:]):
+                coord_dict_chunk = {key: indexer.isel({dim: slice(start, stop)})
+                                    if isinstance(indexer, xarray.DataArray) else indexer
+                                    for key, indexer in coord_dict.items()}
+                futures.append(executor.submit(_interp_chunk, spec, coord_dict_chunk, kwargs))
+            parts = [future.result() for future in futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    dataset_interp = xarray.concat(parts, dim=dim, data_vars='minimal', coords='minimal', compat='override')
+    if name is not None:
+        dataset_interp = dataset_interp[name]
+        if name == '__values__':
+            dataset_interp = dataset_interp.rename(None)
+    return dataset_interp
+
+
+def _attach(block_name, shape, dtype):
+    if block_name not in _attached_blocks:
+        _attached_blocks[block_name] = shared_memory.SharedMemory(name=block_name)
+    array = numpy.ndarray(shape, dtype=dtype, buffer=_attached_blocks[block_name].buf)
+    array.flags.writeable = False
+    return array
+
+
+def _get_vectorized_dim(coord_dict):
+    dims = {indexer.dims for indexer in coord_dict.values() if isinstance(indexer, xarray.DataArray)}
+    if len(dims) != 1:
+        return None
+    dims = dims.pop()
+    return dims[0] if len(dims) == 1 else None
+
+
+def _interp_chunk(spec, coord_dict, kwargs):
+    dataset = spec['coords'].copy()
+    for name, (dims, data, attrs, encoding) in spec['data_vars'].items():
+        if isinstance(data, tuple):
+            data = _attach(*data)
+        dataset[name] = xarray.Variable(dims, data, attrs, encoding)
+    dataset.attrs = spec['attrs']
+    return dataset.interp(**coord_dict, **kwargs)
+
+
+def _reduce_to_bbox(dataset, coord_dict, method=None):
+    if method not in [None, 'linear', 'nearest']:
+        # The interpolation depends on more than the enclosing grid nodes
+        return dataset
+    return dataset.isel(**get_isel_dict_enclosing(dataset, coord_dict))
+
+
+def _share_dataset(dataset, blocks):
+    """
+    Copy the data variables of dataset into shared memory blocks (appended to blocks)
+    :return: dict which can be sent to the worker processes to reconstruct the dataset
+    """
+    data_vars = {}
+    for name, variable in dataset.data_vars.items():
+        array = numpy.ascontiguousarray(variable.values)
+        if array.dtype.hasobject or array.nbytes == 0:
+            data = array
+        else:
+            block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            blocks.append(block)
+            numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            data = (block.name, array.shape, array.dtype.str)
+        data_vars[name] = (variable.dims, data, variable.attrs, variable.encoding)
+    return {'coords': dataset.coords.to_dataset(), 'data_vars': data_vars, 'attrs': dataset.attrs}
@@ -0,0 +1,221 @@
+"""
+Background prefetching for sequential time-window access
+
+Route simulations and replays typically request consecutive time windows with otherwise identical requests. The
+WindowPrefetcher fetches the expected next windows in the background while the caller processes the current one.
+The next windows are either declared by the caller (see WindowPrefetcher.declare) or inferred from the constant
+step between the recent requests.
+"""
+import functools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import xarray
+from pandas import Timedelta
+
+from maridatadownloader.coalescing import _to_naive
+from maridatadownloader.utils import get_start_and_end_time
+
+logger = logging.getLogger(__name__)
+
+
+class WindowPrefetcher:
+    """
+    Prefetch the next time windows of a downloader into a memory-bounded buffer
+
+    Requests are grouped into streams by everything except their time slice. Prefetched windows are loaded into
+    memory and served once; windows which are behind the current window of their stream are evicted.
+    """
+    def __init__(self, downloader, n_ahead=2, max_bytes=256 * 1024 ** 2, max_workers=1, history=3):
+        """
+        :param downloader: DownloaderXarray
+        :param n_ahead: number of windows fetched ahead of the current window
+        :param max_bytes: maximum size of the buffer in bytes (pending windows are estimated by the size of the
+            last window of their stream)
+        :param max_workers: number of background threads
+        :param history: number of recent windows used to infer the step between windows
+        """
+        self.downloader = downloader
+        self.n_ahead = n_ahead
+        self.max_bytes = max_bytes
+        self.history = history
+        self.stats = {'hits': 0, 'misses': 0, 'prefetches': 0}
+        self._buffer = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='maridata-prefetch')
+
+    def close(self):
+        """Cancel pending prefetches and clear the buffer"""
+        with self._lock:
+            for entry in self._buffer.values():
+                entry.future.cancel()
+            self._buffer.clear()
+        self._executor.shutdown(wait=False)
+
+    def declare(self, windows, parameters=None, sel_dict=None, interpolate=False, **kwargs):
+        """
+        Declare the time windows which will be requested next. The first n_ahead windows are fetched immediately.
+
+        :param windows: list of (start, end) tuples
+        :param sel_dict: dict including a time slice, which is replaced by the windows
+        """
+        time_key = _get_time_key(sel_dict)
+        if time_key is None:
+            raise ValueError("sel_dict must contain a time slice ('time', 'time1' or 'time2')")
+        request = _get_request(parameters, sel_dict, interpolate, kwargs)
+        if request is None:
+            raise ValueError("Only requests selecting a time slice without vectorized indexers can be prefetched")
+        stream_key, _, _ = request
+        with self._lock:
+            stream = self._get_stream(stream_key)
+            stream.declared = sorted(_to_window(slice(*window)) for window in windows)
+            next_windows = stream.declared[:self.n_ahead]
+        self._schedule(stream_key, time_key, next_windows, parameters, sel_dict, interpolate, kwargs)
+
+    def download(self, parameters=None, sel_dict=None, isel_dict=None, file_out=None, interpolate=False, **kwargs):
+        """Serve the request from the buffer (if prefetched) and prefetch the next windows"""
+        request = None if isel_dict else _get_request(parameters, sel_dict, interpolate, kwargs)
+        if request is None:
+            return self._download(parameters, sel_dict, isel_dict, file_out, interpolate, **kwargs)
+        stream_key, time_key, window = request
+
+        with self._lock:
+            entry = self._buffer.pop((stream_key, window), None)
+        dataset = None
+        if entry is not None:
+            try:
+                dataset = entry.future.result()
+            except Exception as err:
+                logger.warning(f"Prefetching of window {window} failed, fetch it again: {err}")
+        if dataset is None:
+            self.stats['misses'] += 1
+            dataset = self._download(parameters, sel_dict, None, file_out, interpolate, **kwargs)
+        else:
+            self.stats['hits'] += 1
+            if file_out:
+                logger.info(f"Save dataset to '{file_out}'")
+                self.downloader.save_dataset(dataset, file_out)
+
+        with self._lock:
+            stream = self._get_stream(stream_key)
+            next_windows = self._get_next_windows(stream, window)
+            self._evict(stream_key, window)
+        self._schedule(stream_key, time_key, next_windows, parameters, sel_dict, interpolate, kwargs)
+        return dataset
+
+    def is_active(self):
+        """:return: True if the current thread is executing a download on behalf of the prefetcher"""
+        return getattr(self._local, 'active', False)
+
+    def _download(self, parameters=None, sel_dict=None, isel_dict=None, file_out=None, interpolate=False, **kwargs):
+        self._local.active = True
+        try:
+            return self.downloader.download(parameters=parameters, sel_dict=sel_dict, isel_dict=isel_dict,
+                                            file_out=file_out, interpolate=interpolate, **kwargs)
+        finally:
+            self._local.active = False
+
+    def _evict(self, stream_key, window):
+        """Remove the windows of the stream which are behind window"""
+        for key in [key for key in self._buffer if key[0] == stream_key and key[1][0] < window[0]]:
+            self._buffer.pop(key).future.cancel()
+
+    def _fetch(self, entry, stream, parameters, sel_dict, interpolate, kwargs):
+        dataset = self._download(parameters, sel_dict, interpolate=interpolate, **kwargs).load()
+        with self._lock:
+            entry.nbytes = stream.nbytes = dataset.nbytes
+        return dataset
+
+    def _get_nbytes(self):
+        return sum(entry.nbytes for entry in self._buffer.values())
+
+    def _get_next_windows(self, stream, window):
+        stream.windows.append(window)
+        if stream.declared:
+            return [declared for declared in stream.declared if declared[0] > window[0]][:self.n_ahead]
+        starts = [start for start, _ in stream.windows]
+        steps = [stop - start for start, stop in zip(starts[:-1], starts[1:])]
+        if not steps or steps[-1] <= Timedelta(0) or any(step != steps[-1] for step in steps):
+            return []
+        return [(window[0] + i * steps[-1], window[1] + i * steps[-1]) for i in range(1, self.n_ahead + 1)]
+
+    def _get_stream(self, stream_key):
+        if stream_key not in self._streams:
+            self._streams[stream_key] = _Stream(self.history)
+        return self._streams[stream_key]
+
+    def _schedule(self, stream_key, time_key, windows, parameters, sel_dict, interpolate, kwargs):
+        with self._lock:
+            stream = self._get_stream(stream_key)
+            for window in windows:
+                key = (stream_key, window)
+                if key in self._buffer:
+                    continue
+                if self._get_nbytes() + stream.nbytes > self.max_bytes:
+                    logger.debug(f"Prefetch buffer is full, skip window {window}")
+                    break
+                sel_dict_window = dict(sel_dict)
+                sel_dict_window[time_key] = slice(window[0].to_pydatetime(), window[1].to_pydatetime())
+                entry = _Entry(stream.nbytes)
+                entry.future = self._executor.submit(self._fetch, entry, stream, parameters, sel_dict_window,
+                                                     interpolate, kwargs)
+                self._buffer[key] = entry
+                self.stats['prefetches'] += 1
+                logger.debug(f"Prefetch window {window}")
+
+
+class _Entry:
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self.future = None
+
+
+class _Stream:
+    def __init__(self, history):
+        self.windows = deque(maxlen=history)
+        self.declared = []
+        self.nbytes = 0
+
+
+def prefetchable(download):
+    """
+    Decorator for download methods: route the call through the window prefetcher of the downloader (if enabled).
+    Only the outermost download call is routed, i.e. nested calls (e.g. super().download) and the downloads issued
+    by the prefetcher itself are executed directly.
+    """
+    @functools.wraps(download)
+    def wrapper(self, *args, **kwargs):
+        prefetcher = getattr(self, 'window_prefetcher', None)
+        if prefetcher is None or prefetcher.is_active():
+            return download(self, *args, **kwargs)
+        return prefetcher.download(*args, **kwargs)
+    return wrapper
+
+
+def _get_request(parameters, sel_dict, interpolate, kwargs):
+    """:return: 3-tuple (stream key, time key, window) or None if the request can't be prefetched"""
+    time_key = _get_time_key(sel_dict)
+    if time_key is None or any(isinstance(value, xarray.DataArray) for value in sel_dict.values()):
+        return None
+    try:
+        window = _to_window(sel_dict[time_key])
+    except (ValueError, TypeError):
+        return None
+    other = sorted((key, value) for key, value in sel_dict.items() if key != time_key)
+    stream_key = repr((parameters, time_key, other, interpolate, sorted(kwargs.items())))
+    return stream_key, time_key, window
+
+
+def _get_time_key(sel_dict):
+    if not sel_dict:
+        return None
+    return next((key for key in ['time', 'time1', 'time2'] if isinstance(sel_dict.get(key), slice)), None)
+
+
+def _to_window(time_slice):
+    start, end = get_start_and_end_time(time_slice)
+    return _to_naive(start), _to_naive(end)
@@ -0,0 +1,124 @@
+"""
+Registry of downloader providers
+
+Providers are registered per (downloader_type, platform) with a factory which is only imported when the provider is
+requested for the first time. Thus, importing maridatadownloader doesn't import the backends (cdsapi,
+copernicusmarine, pydap, ...) of providers which are not used.
+
+Third-party packages can add providers via the entry point group 'maridatadownloader.downloaders'. The entry point
+name is '<downloader_type>.<platform>' and the object reference points to a callable with the signature
+`factory(username=None, password=None, **kwargs)`, e.g. in pyproject.toml:
+
+    [project.entry-points."maridatadownloader.downloaders"]
+    "xarray.myplatform" = "mypackage.downloader:create_downloader"
+"""
+import importlib
+import logging
+import threading
+from importlib.metadata import entry_points
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = 'maridatadownloader.downloaders'
+
+_registry = {}
+_registry_lock = threading.Lock()
+_entry_points_loaded = False
+
+
+def get_downloader_factory(downloader_type, platform):
+    """
+    :return: factory callable for the provider
+    :raises ValueError: if no provider is registered for downloader_type/platform
+    """
+    key = (downloader_type.lower(), platform.lower() if platform else None)
+    if key not in _registry:
+        _load_entry_points()
+    if key not in _registry:
+        if any(registered_type == key[0] for registered_type, _ in _registry):
+            raise ValueError(platform)
+        raise ValueError(downloader_type)
+    factory = _registry[key]
+    if isinstance(factory, str):
+        module_name, attr = factory.split(':')
+        factory = getattr(importlib.import_module(module_name), attr)
+        _registry[key] = factory
+    return factory
+
+
+def list_downloaders():
+    """:return: sorted list of registered (downloader_type, platform) tuples"""
+    _load_entry_points()
+    return sorted(_registry)
+
+
+def register_downloader(downloader_type, platform, factory, overwrite=False):
+    """
+    :param downloader_type: str, e.g. 'xarray'
+    :param platform: str, e.g. 'gfs'
+    :param factory: callable `factory(username=None, password=None, **kwargs)` or a reference to it as string
+        '<module>:<attribute>' which is imported lazily
+    :param overwrite: replace an already registered provider
+    """
+    key = (downloader_type.lower(), platform.lower() if platform else None)
+    with _registry_lock:
+        if key in _registry and not overwrite:
+            raise ValueError(f"Downloader '{downloader_type}' for platform '{platform}' is already registered")
+        _registry[key] = factory
+
+
+def _load_entry_points():
+    global _entry_points_loaded
+    with _registry_lock:
+        if _entry_points_loaded:
+            return
+        _entry_points_loaded = True
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            # Python < 3.10
+            eps = eps.get(ENTRY_POINT_GROUP, [])
+        for entry_point in eps:
+            downloader_type, _, platform = entry_point.name.partition('.')
+            key = (downloader_type.lower(), platform.lower() if platform else None)
+            if key in _registry:
+                logger.warning(f"Ignore entry point '{entry_point.name}' because it is already registered")
+                continue
+            _registry[key] = entry_point.value.replace(' ', '')
+
+
+def _create_cdsapi_era5(username=None, password=None, **kwargs):
+    from maridatadownloader.cds import DownloaderCdsApiERA5
+    return DownloaderCdsApiERA5(uuid=username, api_key=password, **kwargs)
+
+
+def _create_cmtapi_cmems(username=None, password=None, **kwargs):
+    from maridatadownloader.copernicus_marine_toolbox import DownloaderCopernicusMarineToolboxApi
+    return DownloaderCopernicusMarineToolboxApi(username=username, password=password, **kwargs)
+
+
+def _create_xarray_cmems(username=None, password=None, **kwargs):
+    from maridatadownloader.xarray import DownloaderXarrayCMEMS
+    assert 'product' in kwargs, "kwargs['product'] is required for platform=cmems"
+    assert 'product_type' in kwargs, "kwargs['product_type'] is required for platform=cmems"
+    assert username, "username is required for platform=cmems"
+    assert password, "password is required for platform=cmems"
+    return DownloaderXarrayCMEMS(kwargs.pop('product'), kwargs.pop('product_type'), username, password, **kwargs)
+
+
+def _create_xarray_etoponcei(username=None, password=None, **kwargs):
+    from maridatadownloader.xarray import DownloaderXarrayETOPONCEI
+    return DownloaderXarrayETOPONCEI(**kwargs)
+
+
+def _create_xarray_gfs(username=None, password=None, **kwargs):
+    from maridatadownloader.xarray import DownloaderXarrayGFS
+    return DownloaderXarrayGFS(username=username, password=password, **kwargs)
+
+
+register_downloader('xarray', 'gfs', _create_xarray_gfs)
+register_downloader('xarray', 'cmems', _create_xarray_cmems)
+register_downloader('xarray', 'etoponcei', _create_xarray_etoponcei)
+register_downloader('cmtapi', 'cmems', _create_cmtapi_cmems)
+register_downloader('cdsapi', 'era5', _create_cdsapi_era5)
@@ -0,0 +1,135 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT_HTTP_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+
+class FetchError(Exception):
+    """Raised if some pieces of a multi-URL request could not be fetched. The pieces fetched so far are kept in
+    `completed` so that the request can be resumed."""
+    def __init__(self, message, completed, errors):
+        super().__init__(message)
+        self.completed = completed
+        self.errors = errors
+
+
+class FetchScheduler:
+    """
+    Shared scheduler for remote reads
+
+    - limits the number of concurrent requests per host
+    - retries transient failures (connection errors, timeouts, HTTP 408/429/5xx) with exponential backoff and full
+      jitter
+    - fetches multi-URL requests in parallel and keeps the pieces already fetched so that a partially completed
+      request can be resumed (see `fetch_all`)
+    """
+    def __init__(self, max_per_host=4, max_retries=5, backoff_base=1.0, backoff_max=60.0, max_workers=8):
+        """
+        :param max_per_host: maximum number of concurrent requests per host
+        :param max_retries: maximum number of retries of a single request
+        :param backoff_base: base delay in seconds of the exponential backoff
+        :param backoff_max: maximum delay in seconds between two retries
+        :param max_workers: number of threads used by fetch_all
+        """
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_workers = max_workers
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def call(self, url, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) respecting the concurrency limit of the host of `url` and retrying transient
+        failures
+
+        :param url: URL or host name used for the concurrency limit
+        """
+        host = get_host(url)
+        attempt = 0
+        while True:
+            with self._get_semaphore(host):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as err:
+                    if attempt >= self.max_retries or not is_transient(err):
+                        raise
+                    error = err
+            attempt += 1
+            delay = self.get_backoff_delay(attempt)
+            logger.warning(f"Transient error for '{url}' (attempt {attempt}/{self.max_retries}), "
+                           f"retry in {delay:.1f} s: {error}")
+            time.sleep(delay)
+
+    def fetch_all(self, urls, func, completed=None):
+        """
+        Fetch all urls in parallel using func(url)
+
+        :param urls: list of URLs
+        :param func: callable taking a URL and returning the fetched piece
+        :param completed: dict {url: piece} of pieces which have already been fetched. It is updated in-place,
+            so passing the same dict again after a FetchError resumes the request.
+        :return: list of pieces in the order of urls
+        """
+        if completed is None:
+            completed = {}
+        pending = [url for url in dict.fromkeys(urls) if url not in completed]
+        if pending:
+            logger.info(f"Fetch {len(pending)} of {len(urls)} pieces ({len(urls) - len(pending)} already fetched)")
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {url: executor.submit(self.call, url, func, url) for url in pending}
+            for url, future in futures.items():
+                try:
+                    completed[url] = future.result()
+                except Exception as err:
+                    errors[url] = err
+        if errors:
+            raise FetchError(f"Could not fetch {len(errors)} of {len(urls)} pieces", completed, errors)
+        return [completed[url] for url in urls]
+
+    def get_backoff_delay(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _get_semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+    """:return: FetchScheduler shared by all downloaders which are not given a dedicated scheduler"""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = FetchScheduler()
+        return _default_scheduler
+
+
+def get_host(url):
+    netloc = urlparse(url).netloc
+    return netloc if netloc else url
+
+
+def is_transient(err):
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and err.response.status_code in TRANSIENT_HTTP_STATUS_CODES
+    if isinstance(err, (FileNotFoundError, PermissionError)):
+        return False
+    # Includes requests.ConnectionError/Timeout and NetCDF/OPeNDAP I/O failures (OSError)
+    return isinstance(err, (OSError, TimeoutError, ConnectionError))
@@ -0,0 +1,346 @@
+import json
+import logging
+import queue
+import threading
+import time as time_module
+from collections import OrderedDict, deque
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import floor
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import xarray
+
+logger = logging.getLogger(__name__)
+
+
+class PointQueryService:
+    """
+    Long-running service for many small point queries (time, latitude, longitude)
+
+    The downloaders registered with `add_dataset` keep their datasets open for the lifetime of the service.
+    Data is fetched in space-time blocks (block_size x block_hours) which are kept in an in-memory LRU cache.
+    Concurrent queries are collected by a worker thread into micro-batches (at most max_batch_size queries or
+    max_wait seconds) and all queries of a batch falling into the same block are answered by one vectorized
+    interpolation.
+
+    Example:
+        service = PointQueryService()
+        service.add_dataset('gfs', DownloaderFactory.get_downloader('xarray', 'gfs'),
+                            parameters=['Temperature_surface'])
+        service.start()
+        service.query('gfs', '2023-11-24T10:30:00', 54.1, 7.3)
+
+    The service can also be exposed via HTTP (see `serve`).
+    """
+    def __init__(self, block_size=5.0, block_hours=24, buffer_space=1.0, buffer_hours=3, cache_size=32,
+                 max_batch_size=1024, max_wait=0.005):
+        """
+        :param block_size: spatial extent of a cached block in degrees
+        :param block_hours: temporal extent of a cached block in hours
+        :param buffer_space: spatial buffer added to each block in degrees
+        :param buffer_hours: temporal buffer added to each block in hours
+        :param cache_size: maximum number of blocks kept in memory
+        :param max_batch_size: maximum number of queries per micro-batch
+        :param max_wait: maximum time in seconds to wait for further queries before a micro-batch is processed
+        """
+        self.block_size = block_size
+        self.block_hours = block_hours
+        self.buffer_space = buffer_space
+        self.buffer_hours = buffer_hours
+        self.cache_size = cache_size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.datasets = {}
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._running = False
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=10000)
+        self._reset_stats()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def add_dataset(self, name, downloader, parameters=None, sel_dict=None, method='linear'):
+        """
+        :param name: name used to query the dataset
+        :param downloader: downloader object (e.g. created via DownloaderFactory.get_downloader)
+        :param parameters: str or list passed to downloader.download
+        :param sel_dict: additional (fixed) coordinate selection, e.g. {'height_above_ground': 10}
+        :param method: interpolation method used for xarray.Dataset.interp
+        """
+        self.datasets[name] = {
+            'downloader': downloader,
+            # A list so that the downloader returns a Dataset
+            'parameters': [parameters] if isinstance(parameters, str) else parameters,
+            'sel_dict': sel_dict if sel_dict else {},
+            'method': method
+        }
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def get_stats(self):
+        """
+        :return: dict with throughput and latency counters
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+            latencies = np.array(self._latencies)
+        elapsed = time_module.monotonic() - self._start_time
+        stats['uptime'] = elapsed
+        stats['throughput'] = stats['queries'] / elapsed if elapsed > 0 else 0.
+        stats['mean_batch_size'] = stats['queries'] / stats['batches'] if stats['batches'] else 0.
+        if latencies.size:
+            stats['latency_mean'] = float(latencies.mean())
+            stats['latency_p50'] = float(np.percentile(latencies, 50))
+            stats['latency_p95'] = float(np.percentile(latencies, 95))
+            stats['latency_max'] = float(latencies.max())
+        return stats
+
+    def query(self, name, time, latitude, longitude, timeout=None):
+        """
+        Query values of a single point. The call blocks until the micro-batch containing the query is processed.
+
+        :param name: name of the dataset (see add_dataset)
+        :param time: str, datetime.datetime or numpy.datetime64. Ignored for datasets without time dimension.
+        :param latitude: numerical
+        :param longitude: numerical
+        :param timeout: timeout in seconds
+        :return: dict with parameter names as keys
+        """
+        if name not in self.datasets:
+            raise ValueError(f"Unknown dataset '{name}'")
+        if not self._running:
+            raise RuntimeError("Service is not running. Call .start() first.")
+        point_query = _PointQuery(name, _to_datetime64(time), float(latitude), float(longitude))
+        self._queue.put(point_query)
+        if not point_query.done.wait(timeout):
+            raise TimeoutError(f"Query did not finish within {timeout} seconds")
+        if point_query.error is not None:
+            raise point_query.error
+        return point_query.result
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._reset_stats()
+
+    def serve(self, host='127.0.0.1', port=8080):
+        """
+        Expose the service via HTTP. Blocks until interrupted.
+
+        Endpoints:
+         - GET /query?dataset=<name>&time=<iso time>&latitude=<lat>&longitude=<lon>
+         - GET /stats
+        """
+        if not self._running:
+            self.start()
+        server = ThreadingHTTPServer((host, port), _make_request_handler(self))
+        logger.info(f"Serving point queries on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._worker = threading.Thread(target=self._run, name='PointQueryService', daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._queue.put(None)
+        self._worker.join()
+        self._worker = None
+
+    def _collect_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time_module.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time_module.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                point_query = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if point_query is None:
+                # Re-insert sentinel so the worker stops after processing the current batch
+                self._queue.put(None)
+                break
+            batch.append(point_query)
+        return batch
+
+    def _get_block(self, name, block_key):
+        cache_key = (name, block_key)
+        with self._cache_lock:
+            if cache_key in self._cache:
+                self._cache.move_to_end(cache_key)
+                self._increment('cache_hits')
+                return self._cache[cache_key]
+        self._increment('cache_misses')
+
+        config = self.datasets[name]
+        lat_idx, lon_idx, time_idx = block_key
+        sel_dict = dict(config['sel_dict'])
+        sel_dict['latitude'] = slice(lat_idx * self.block_size - self.buffer_space,
+                                     (lat_idx + 1) * self.block_size + self.buffer_space)
+        sel_dict['longitude'] = slice(lon_idx * self.block_size - self.buffer_space,
+                                      (lon_idx + 1) * self.block_size + self.buffer_space)
+        if time_idx is not None:
+            time_start = (pd.Timestamp(0) + time_idx * timedelta(hours=self.block_hours)).to_pydatetime()
+            time_slice = slice(time_start - timedelta(hours=self.buffer_hours),
+                               time_start + timedelta(hours=self.block_hours + self.buffer_hours))
+            # Keys which are not dimensions of the dataset are removed by the downloader
+            for time_key in ['time', 'time1', 'time2']:
+                sel_dict.setdefault(time_key, time_slice)
+        block = config['downloader'].download(parameters=config['parameters'], sel_dict=sel_dict).load()
+
+        with self._cache_lock:
+            self._cache[cache_key] = block
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return block
+
+    def _get_block_key(self, point_query):
+        lat_idx = floor(point_query.latitude / self.block_size)
+        lon_idx = floor(point_query.longitude / self.block_size)
+        time_idx = None
+        if point_query.time is not None and self._has_time(point_query.name):
+            time_idx = floor((pd.Timestamp(point_query.time) - pd.Timestamp(0)) / timedelta(hours=self.block_hours))
+        return lat_idx, lon_idx, time_idx
+
+    def _has_time(self, name):
+        dataset = self.datasets[name]['downloader'].dataset
+        return dataset is not None and any(dim in dataset.dims for dim in ['time', 'time1', 'time2'])
+
+    def _increment(self, key, value=1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    def _interpolate(self, name, block, point_queries):
+        indexers = {
+            'latitude': xarray.DataArray([q.latitude for q in point_queries], dims=['point']),
+            'longitude': xarray.DataArray([q.longitude for q in point_queries], dims=['point'])
+        }
+        if 'time' in block.dims:
+            # Interpolation over datetimes of different resolution (e.g. ns vs. us) yields NaN
+            indexers['time'] = xarray.DataArray(np.array([q.time for q in point_queries]).astype(block['time'].dtype),
+                                                dims=['point'])
+        values = block.interp(**indexers, method=self.datasets[name]['method'])
+        for n, point_query in enumerate(point_queries):
+            point_values = values.isel(point=n)
+            point_query.result = {var: point_values[var].values.squeeze().tolist() for var in point_values.data_vars}
+
+    def _process_batch(self, batch):
+        groups = {}
+        for point_query in batch:
+            key = (point_query.name, self._get_block_key(point_query))
+            groups.setdefault(key, []).append(point_query)
+        for (name, block_key), point_queries in groups.items():
+            try:
+                block = self._get_block(name, block_key)
+                self._interpolate(name, block, point_queries)
+            except Exception as err:
+                logger.exception(f"Failed to process {len(point_queries)} queries for dataset '{name}'")
+                self._increment('errors', len(point_queries))
+                for point_query in point_queries:
+                    point_query.error = err
+        now = time_module.monotonic()
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['queries'] += len(batch)
+            self._stats['blocks_interpolated'] += len(groups)
+            for point_query in batch:
+                self._latencies.append(now - point_query.submitted)
+        for point_query in batch:
+            point_query.done.set()
+
+    def _reset_stats(self):
+        self._start_time = time_module.monotonic()
+        self._stats = {'queries': 0, 'batches': 0, 'blocks_interpolated': 0, 'cache_hits': 0, 'cache_misses': 0,
+                       'errors': 0}
+        self._latencies.clear()
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            self._process_batch(batch)
+
+
+class _PointQuery:
+    def __init__(self, name, time, latitude, longitude):
+        self.name = name
+        self.time = time
+        self.latitude = latitude
+        self.longitude = longitude
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.submitted = time_module.monotonic()
+
+
+def _make_request_handler(service):
+    class PointQueryRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                if url.path == '/query':
+                    body = service.query(params['dataset'], params.get('time'), params['latitude'],
+                                         params['longitude'])
+                elif url.path == '/stats':
+                    body = service.get_stats()
+                else:
+                    self._send(404, {'error': f"Unknown endpoint '{url.path}'"})
+                    return
+            except (KeyError, ValueError) as err:
+                self._send(400, {'error': str(err)})
+                return
+            except Exception as err:
+                self._send(500, {'error': str(err)})
+                return
+            self._send(200, body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def _send(self, status, body):
+            content = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return PointQueryRequestHandler
+
+
+def _to_datetime64(time_):
+    """Convert to timezone-unaware numpy.datetime64 (UTC)"""
+    if time_ is None:
+        return None
+    timestamp = pd.Timestamp(time_)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp.to_datetime64()
@@ -1,17 +1,118 @@
+import logging
 from datetime import datetime
+from functools import partial
 
 import numpy as np
 import pandas as pd
 import xarray
 
 from maridatadownloader import DownloaderFactory
+from maridatadownloader.parallel import interp_parallel
+
+logger = logging.getLogger(__name__)
+
+# Product and default parameters used for the environmental data of a trajectory
+TRAJECTORY_PRODUCTS = {
+    'currents': ('cmems_mod_glo_phy_anfc_merged-uv_PT1H-i', ['utotal', 'vtotal']),
+    'physics': ('cmems_mod_glo_phy_anfc_0.083deg_PT1H-m', ['thetao', 'so', 'zos']),
+    'wave': ('cmems_mod_glo_wav_anfc_0.083deg_PT3H-i', ['VHM0', 'VMDR', 'VTPK']),
+    'weather': ('gfs', ["Temperature_surface", "Pressure_reduced_to_MSL_msl", "Wind_speed_gust_surface",
+                        "u-component_of_wind_height_above_ground", "v-component_of_wind_height_above_ground"])
+}
+
+
+class TrajectoryTable:
+    """
+    Columnar table for data interpolated along trajectories
+
+    The columns are preallocated numpy arrays with one row per trajectory point. The variables (and coordinates) of
+    the interpolated datasets are copied straight from their arrays along the trajectory dimension into the rows of
+    the columns. Thus, unlike Dataset.to_dataframe() followed by pd.concat, no index over all coordinates is built
+    and every value is copied only once. The pandas.DataFrame returned by to_dataframe uses the column arrays
+    without copying them.
+
+    Rows which are not written by any source are missing values (NaN/NaT/None). Integer and boolean columns are
+    stored as float and string columns as object for this reason.
+    """
+    def __init__(self, n_rows, dim='trajectory'):
+        """
+        :param n_rows: number of trajectory points
+        :param dim: name of the trajectory dimension of the interpolated datasets
+        """
+        self.n_rows = n_rows
+        self.dim = dim
+        self.columns = {}
+        self._sources = {}
+
+    @classmethod
+    def from_datasets(cls, datasets, dim='trajectory'):
+        """
+        :param datasets: list of xarray.Dataset interpolated along the same trajectory. Columns which are contained in
+            several datasets are taken from the first one.
+        """
+        table = cls(datasets[0].sizes[dim], dim=dim)
+        for source, dataset in enumerate(datasets):
+            table.insert(dataset, source=source)
+        return table
+
+    def insert(self, dataset, rows=None, source=None):
+        """
+        Copy the variables and coordinates of dataset into the table
+
+        Dimensions other than the trajectory dimension must have size 1 (e.g. depth), scalar variables are broadcast.
+
+        :param dataset: xarray.Dataset interpolated along the trajectory dimension
+        :param rows: positions of the points of dataset in the table (default: all rows)
+        :param source: identifier of the data source. A column which already exists is only written again by the
+            source which created it, i.e. the first source wins for columns contained in several sources.
+        """
+        if rows is None:
+            rows = slice(None)
+        for name, variable in list(dataset.coords.variables.items()) + list(dataset.data_vars.variables.items()):
+            if name == self.dim:
+                continue
+            if name in self.columns and self._sources[name] != source:
+                continue
+            variable = variable.squeeze([dim for dim in variable.dims if dim != self.dim and variable.sizes[dim] == 1])
+            if variable.dims not in [(self.dim,), ()]:
+                raise ValueError(f"Variable '{name}' has dimensions {variable.dims}, expected ('{self.dim}',)")
+            if name not in self.columns:
+                self.columns[name] = _allocate_column(self.n_rows, variable.dtype)
+                self._sources[name] = source
+            self.columns[name][rows] = variable.values
+
+    def to_dataframe(self, columns=None, rows=None, index=False):
+        """
+        :param columns: list of columns which are moved to the front (missing columns are ignored)
+        :param rows: slice of rows; the columns of the pandas.Dataframe are views of the table columns. The
+            trajectory points are numbered from 0 within the slice.
+        :param index: use the trajectory dimension as index instead of as column
+        :return: pandas.Dataframe
+        """
+        if rows is None:
+            rows = slice(None)
+        # The points are numbered from the start of the slice
+        data = {} if index else {self.dim: np.arange(len(range(self.n_rows)[rows]))}
+        data.update({name: values[rows] for name, values in self.columns.items()})
+        if columns is not None:
+            data = {name: data[name] for name in [col for col in columns if col in data] +
+                    [col for col in data if col not in columns]}
+        df = pd.DataFrame(data, copy=False)
+        if index:
+            df.index = pd.RangeIndex(len(df), name=self.dim)
+        return df
 
 
 def enrich_trajectory_with_env_data(csv_file, username, password, method_interp='nearest', method_extrap='linear',
-                                    columns=None):
+                                    columns=None, resolutions=None):
     """
+    :param resolutions: dict with kind (see TRAJECTORY_PRODUCTS) as key and the grid resolution of the product as
+        value, used to interpolate only once per grid node (see interp_deduplicated)
     :return:
     """
+    if resolutions is None:
+        resolutions = {}
+
     kwargs_gfs = {
         'csv_file': csv_file,
         'method_interp': method_interp,
@@ -28,102 +129,114 @@ def enrich_trajectory_with_env_data(csv_file, username, password, method_interp=
     if columns is None:
         columns = ['trajectory', 'time', 'longitude', 'latitude', 'depth', 'height_above_ground']
 
-    df_currents = enrich_trajectory_with_currents_data(**kwargs_cmems)
-    df_physics = enrich_trajectory_with_physics_data(**kwargs_cmems)
-    df_wave = enrich_trajectory_with_wave_data(**kwargs_cmems)
-    df_weather = enrich_trajectory_with_weather_data(**kwargs_gfs)
+    currents_trajectory = get_trajectory_dataset('currents', resolution=resolutions.get('currents'), **kwargs_cmems)
+    physics_trajectory = get_trajectory_dataset('physics', resolution=resolutions.get('physics'), **kwargs_cmems)
+    wave_trajectory = get_trajectory_dataset('wave', resolution=resolutions.get('wave'), **kwargs_cmems)
+    weather_trajectory = get_trajectory_dataset('weather', resolution=resolutions.get('weather'), **kwargs_gfs)
 
-    # Merge dataframes
-    data_frames = [df_weather, df_wave, df_physics.reset_index(), df_currents.reset_index()]
-    df_env_data = pd.concat(data_frames, axis=1)
-    # Remove duplicate columns
-    df_env_data = df_env_data.loc[:, ~df_env_data.columns.duplicated()]
-    # Change column order
-    df_env_data = df_env_data[columns + [col for col in df_env_data.columns.to_list() if col not in columns]]
-    return df_env_data
+    # Assemble the interpolated arrays into one table. Columns which are contained in several datasets (e.g. time,
+    # latitude, longitude) are taken from the first one.
+    table = TrajectoryTable.from_datasets([weather_trajectory, wave_trajectory, physics_trajectory,
+                                           currents_trajectory])
+    return table.to_dataframe(columns=columns)
 
 
-def enrich_trajectory_with_currents_data(csv_file, username, password, parameters=None,
-                                         method_interp='nearest', method_extrap='linear'):
+def enrich_trajectories_with_env_data(csv_files, username, password, method_interp='nearest', method_extrap='linear',
+                                      columns=None, time_window='1D', tile_size=10, resolutions=None):
     """
-    :return: pandas.Dataframe
+    Batch version of enrich_trajectory_with_env_data for many trajectories (e.g. the tracks of a whole fleet)
+
+    The positions of all trajectories are pooled and grouped into space-time blocks (time_window x tile_size).
+    Every block is downloaded only once per product and all points falling into it are interpolated in a single
+    vectorized call. Thus, the transferred data scales with the area covered by the fleet and not with the number
+    of trajectories.
+
+    :param csv_files: list of csv files, one trajectory per file
+    :param time_window: temporal extent of a block as pandas frequency string, e.g. '1D' or '6h'
+    :param tile_size: spatial extent of a block in degrees
+    :param resolutions: see enrich_trajectory_with_env_data
+    :return: dict with csv file as key and pandas.Dataframe as value
     """
-    if parameters is None:
-        parameters = ['utotal', 'vtotal']
+    if resolutions is None:
+        resolutions = {}
+    if columns is None:
+        columns = ['trajectory', 'time', 'longitude', 'latitude', 'depth', 'height_above_ground']
 
-    df_positions = read_hf_data_positions(csv_file)
-    sel_dict = get_trajectory_dict(df_positions)
+    df_fleet = read_fleet_positions(csv_files)
+    blocks = get_fleet_blocks(df_fleet, time_window=time_window, tile_size=tile_size)
 
-    currents_trajectory = get_cmems_trajectory('cmems_mod_glo_phy_anfc_merged-uv_PT1H-i', 'nrt',
-                                               username, password, parameters, sel_dict,
-                                               method_interp=method_interp, method_extrap=method_extrap)
+    table = TrajectoryTable(len(df_fleet))
 
-    df_currents = currents_trajectory.to_dataframe()
-    return df_currents
+    # The CMEMS blocks are fetched via the Copernicus Marine Toolbox API (OPeNDAP is not supported by CMEMS any
+    # more). A single downloader is used for all products. It is created first so that a failing login is
+    # reported before any data is downloaded.
+    cmems = DownloaderFactory.get_downloader('cmtapi', 'cmems', username, password)
+    gfs = DownloaderFactory.get_downloader('xarray', 'gfs')
+    interp_func = partial(interp_gfs_trajectory, gfs, TRAJECTORY_PRODUCTS['weather'][1], method_interp=method_interp)
+    interp_func = partial(interp_deduplicated, interp_func, resolutions.get('weather'), method=method_interp)
+    interp_fleet_blocks(df_fleet, blocks, interp_func, table=table, source='weather')
+
+    # Same order as in enrich_trajectory_with_env_data so that duplicate columns are resolved identically
+    for kind in ['wave', 'physics', 'currents']:
+        product, parameters = TRAJECTORY_PRODUCTS[kind]
+        cmems.set_product(product)
+        interp_func = partial(interp_cmems_trajectory, cmems, parameters, method_interp=method_interp,
+                              method_extrap=method_extrap)
+        interp_func = partial(interp_deduplicated, interp_func, resolutions.get(kind), method=method_interp)
+        interp_fleet_blocks(df_fleet, blocks, interp_func, table=table, source=kind)
+
+    # Split into the individual trajectories. The rows of a trajectory are contiguous (see read_fleet_positions),
+    # thus the columns of each trajectory are views of the table columns.
+    tracks = df_fleet['track'].to_numpy()
+    results = {}
+    for track, csv_file in enumerate(csv_files):
+        start, stop = np.searchsorted(tracks, [track, track + 1])
+        results[csv_file] = table.to_dataframe(columns=columns, rows=slice(start, stop))
+    return results
+
+
+def enrich_trajectory_with_currents_data(csv_file, username, password, parameters=None, resolution=None,
+                                         method_interp='nearest', method_extrap='linear'):
+    """
+    :return: pandas.Dataframe
+    """
+    currents_trajectory = get_trajectory_dataset('currents', csv_file, username, password, parameters=parameters,
+                                                 method_interp=method_interp, method_extrap=method_extrap,
+                                                 resolution=resolution)
+    return TrajectoryTable.from_datasets([currents_trajectory]).to_dataframe(index=True)
 
 
-def enrich_trajectory_with_physics_data(csv_file, username, password, parameters=None,
+def enrich_trajectory_with_physics_data(csv_file, username, password, parameters=None, resolution=None,
                                         method_interp='nearest', method_extrap='linear'):
     """
     :return: pandas.Dataframe
     """
-    if parameters is None:
-        parameters = ['thetao', 'so', 'zos']
+    physics_trajectory = get_trajectory_dataset('physics', csv_file, username, password, parameters=parameters,
+                                                method_interp=method_interp, method_extrap=method_extrap,
+                                                resolution=resolution)
+    return TrajectoryTable.from_datasets([physics_trajectory]).to_dataframe(index=True)
 
-    df_positions = read_hf_data_positions(csv_file)
-    sel_dict = get_trajectory_dict(df_positions)
 
-    physics_trajectory = get_cmems_trajectory('cmems_mod_glo_phy_anfc_0.083deg_PT1H-m', 'nrt',
-                                              username, password, parameters, sel_dict,
-                                              method_interp=method_interp, method_extrap=method_extrap)
-
-    df_physics = physics_trajectory.to_dataframe()
-    return df_physics
-
-
-def enrich_trajectory_with_wave_data(csv_file, username, password, parameters=None,
+def enrich_trajectory_with_wave_data(csv_file, username, password, parameters=None, resolution=None,
                                      method_interp='nearest', method_extrap='linear'):
     """
     :return: pandas.Dataframe
     """
-    if parameters is None:
-        parameters = ['VHM0', 'VMDR', 'VTPK']
-
-    df_positions = read_hf_data_positions(csv_file)
-    sel_dict = get_trajectory_dict(df_positions)
+    wave_trajectory = get_trajectory_dataset('wave', csv_file, username, password, parameters=parameters,
+                                             method_interp=method_interp, method_extrap=method_extrap,
+                                             resolution=resolution)
+    return TrajectoryTable.from_datasets([wave_trajectory]).to_dataframe(index=True)
 
-    wave_trajectory = get_cmems_trajectory('cmems_mod_glo_wav_anfc_0.083deg_PT3H-i', 'nrt',
-                                           username, password, parameters, sel_dict,
-                                           method_interp=method_interp, method_extrap=method_extrap)
 
-    df_wave = wave_trajectory.to_dataframe()
-    # path, ext = os.path.splitext(csv_file)
-    # csv_file_out = path + '_cmems_wave' + ext
-    # df_wave.to_csv(csv_file_out)
-    return df_wave
-
-
-def enrich_trajectory_with_weather_data(csv_file, parameters=None, height_above_ground=10, method_interp='nearest'):
+def enrich_trajectory_with_weather_data(csv_file, parameters=None, height_above_ground=10, method_interp='nearest',
+                                        resolution=None):
     """
     :return: pandas.Dataframe
     """
-    if parameters is None:
-        parameters = ["Temperature_surface", "Pressure_reduced_to_MSL_msl", "Wind_speed_gust_surface",
-                      "u-component_of_wind_height_above_ground", "v-component_of_wind_height_above_ground"]
-
-    df_positions = read_hf_data_positions(csv_file)
-    sel_dict = get_trajectory_dict(df_positions)
-
-    sel_dict['time1'] = sel_dict['time']
-    if height_above_ground:
-        sel_dict['height_above_ground'] = height_above_ground
-        sel_dict['height_above_ground2'] = height_above_ground
-
-    gfs = DownloaderFactory.get_downloader('xarray', 'gfs')
-    weather_trajectory = gfs.download(parameters=parameters, sel_dict=sel_dict, interpolate=True,
-                                      method=method_interp)
-    df_weather = weather_trajectory.to_dataframe()
-    return df_weather
+    weather_trajectory = get_trajectory_dataset('weather', csv_file, parameters=parameters,
+                                                height_above_ground=height_above_ground, method_interp=method_interp,
+                                                resolution=resolution)
+    return TrajectoryTable.from_datasets([weather_trajectory]).to_dataframe(index=True)
 
 
 def fill_nan(dataset, **kwargs):
@@ -171,39 +284,63 @@ def get_cmems_sub_cube(downloader, parameters, time_min, time_max, lon_min, lon_
     time_next_lower = downloader.dataset.time.sel(time=time_min, method='ffill')
     time_next_upper = downloader.dataset.time.sel(time=time_max, method='bfill')
 
-    sub_cube = downloader.download(parameters=parameters, sel_dict={'time': slice(time_next_lower, time_next_upper)})
-    sub_cube = sub_cube.sel(latitude=slice(lat_min - spatial_buffer, lat_max + spatial_buffer),
-                            longitude=slice(lon_min - spatial_buffer, lon_max + spatial_buffer))
-    return sub_cube
+    # Select the spatial extent within the download so that only the block (and not the global grid) is fetched
+    sel_dict = {'time': slice(time_next_lower, time_next_upper),
+                'latitude': slice(float(lat_min) - spatial_buffer, float(lat_max) + spatial_buffer),
+                'longitude': slice(float(lon_min) - spatial_buffer, float(lon_max) + spatial_buffer)}
+    return downloader.download(parameters=parameters, sel_dict=sel_dict)
 
 
 def get_cmems_trajectory(product, product_type, username, password, parameters, sel_dict,
-                         spatial_buffer=1, method_interp='nearest', method_extrap='linear'):
+                         spatial_buffer=1, method_interp='nearest', method_extrap='linear', n_workers=None):
     """
-    :return: pandas.Dataframe
+    :param n_workers: number of processes used for the interpolation (see maridatadownloader.parallel)
+    :return: xarray.Dataset
     """
     cmems = DownloaderFactory.get_downloader('xarray', 'cmems', username, password,
                                              product=product, product_type=product_type)
+    return interp_cmems_trajectory(cmems, parameters, sel_dict, spatial_buffer=spatial_buffer,
+                                   method_interp=method_interp, method_extrap=method_extrap, n_workers=n_workers)
 
-    assert 'time' in sel_dict
-    assert 'longitude' in sel_dict
-    assert 'latitude' in sel_dict
 
-    time_min = min(sel_dict['time'])
-    time_max = max(sel_dict['time'])
-    lon_min = min(sel_dict['longitude'])
-    lon_max = max(sel_dict['longitude'])
-    lat_min = min(sel_dict['latitude'])
-    lat_max = max(sel_dict['latitude'])
+def get_fleet_blocks(df_positions, time_window='1D', tile_size=10):
+    """
+    Group positions into space-time blocks
+    :param df_positions: pandas.Dataframe with columns 'time', 'latitude' and 'longitude'
+    :param time_window: temporal extent of a block as pandas frequency string
+    :param tile_size: spatial extent of a block in degrees
+    :return: list of numpy arrays with the (positional) row indices of each block
+    """
+    keys = [pd.to_datetime(df_positions['time']).dt.floor(time_window).to_numpy(),
+            np.floor(df_positions['latitude'].to_numpy() / tile_size),
+            np.floor(df_positions['longitude'].to_numpy() / tile_size)]
+    return list(df_positions.groupby(keys, sort=True).indices.values())
 
-    # CMEMS data has NaN values on land pixels, thus we need to extrapolate NaN values close to the coast to make
-    # sure that we have no NaN values in the interpolated data for the trajectory
-    sub_cube = get_cmems_sub_cube(cmems, parameters, time_min, time_max, lon_min, lon_max, lat_min, lat_max,
-                                  spatial_buffer)
-    if has_nan(sub_cube):
-        sub_cube = fill_nan(sub_cube, method=method_extrap)
-    dataset_trajectory = sub_cube.interp(**sel_dict, method=method_interp)
-    return dataset_trajectory
+
+def get_trajectory_dataset(kind, csv_file, username=None, password=None, parameters=None, height_above_ground=10,
+                           method_interp='nearest', method_extrap='linear', resolution=None):
+    """
+    Interpolate the environmental data of one kind along the trajectory of a csv file
+    :param kind: key of TRAJECTORY_PRODUCTS, i.e. 'currents', 'physics', 'wave' or 'weather'
+    :param parameters: default: parameters of TRAJECTORY_PRODUCTS
+    :param resolution: grid of the product used to deduplicate the trajectory points (see get_trajectory_stencils)
+    :return: xarray.Dataset
+    """
+    product, default_parameters = TRAJECTORY_PRODUCTS[kind]
+    if parameters is None:
+        parameters = default_parameters
+
+    df_positions = read_hf_data_positions(csv_file)
+    sel_dict = get_trajectory_dict(df_positions)
+
+    if kind == 'weather':
+        gfs = DownloaderFactory.get_downloader('xarray', 'gfs')
+        interp_func = partial(interp_gfs_trajectory, gfs, parameters, height_above_ground=height_above_ground,
+                              method_interp=method_interp)
+    else:
+        interp_func = partial(get_cmems_trajectory, product, 'nrt', username, password, parameters,
+                              method_interp=method_interp, method_extrap=method_extrap)
+    return interp_deduplicated(interp_func, resolution, sel_dict=sel_dict, method=method_interp)
 
 
 def get_trajectory_dict(df_positions, every_nth_row=1):
@@ -227,6 +364,81 @@ def get_trajectory_dict(df_positions, every_nth_row=1):
     return sel_dict
 
 
+def get_trajectory_stencils(sel_dict, resolution, method='nearest'):
+    """
+    Group the points of a trajectory which share the same interpolation stencil on the grid of the target product
+
+    For method 'nearest', the stencil of a point is its nearest node of the grid defined by resolution. For method
+    'linear', the stencil consists of the corners of the enclosing grid cell and the points are weighted by their
+    multilinear interpolation weights. Dimensions which are not part of the resolution are compared exactly.
+
+    :param sel_dict: dict of 1-D xarray.DataArray with a common dimension, as returned by get_trajectory_dict
+    :param resolution: dict with the grid spacing per dimension, e.g. {'latitude': 0.25, 'longitude': 0.25,
+        'time': '3h'}. The optional key 'origin' defines a grid node per dimension, e.g. {'time': '2024-01-01T00:30'}
+        (default: 0 and 1970-01-01T00:00).
+    :param method: 'nearest' or 'linear'
+    :return: 3-tuple (sel_dict with one point per grid node, numpy array with the indices of the grid nodes of the
+        stencil of every original point (shape: points x stencil size), numpy array with the corresponding weights)
+    """
+    if method not in ['nearest', 'linear']:
+        raise ValueError(f"Deduplication by resolution is not supported for the interpolation method '{method}'")
+    origin = resolution.get('origin', {})
+    n_points = next(indexer.size for indexer in sel_dict.values() if isinstance(indexer, xarray.DataArray))
+    keys = {}
+    weights = np.ones((n_points, 1))
+    time_names = set()
+    for name, indexer in sel_dict.items():
+        if not isinstance(indexer, xarray.DataArray):
+            continue
+        values = indexer.values
+        if np.issubdtype(values.dtype, np.datetime64) or values.dtype == object:
+            # Datetimes (timezone-aware ones are converted to UTC)
+            time_names.add(name)
+            values = pd.to_datetime(values, utc=True).tz_localize(None).to_numpy(dtype='datetime64[ns]').view('int64')
+            if name in resolution:
+                values = values - pd.Timestamp(origin.get(name, 0)).value
+                positions = values / pd.Timedelta(resolution[name]).value
+            else:
+                keys[name] = values[:, np.newaxis]
+                continue
+        elif name in resolution:
+            positions = (values - origin.get(name, 0)) / resolution[name]
+        else:
+            keys[name] = np.ascontiguousarray(values, dtype=float).view('int64')[:, np.newaxis]
+            continue
+        if method == 'nearest':
+            keys[name] = _round_half_down(positions)[:, np.newaxis]
+            continue
+        # Lower and upper corner of the enclosing cell. Points on a grid node only need the lower corner.
+        lower = np.floor(positions)
+        fraction = positions - lower
+        upper = np.where(fraction > 0, lower + 1, lower)
+        # Extend the stencil by this dimension (all combinations with the corners of the previous dimensions)
+        keys = {key: np.repeat(corners, 2, axis=1) for key, corners in keys.items()}
+        keys[name] = np.tile(np.stack([lower, upper], axis=1).astype('int64'), (1, weights.shape[1]))
+        weights = (weights[:, :, np.newaxis] * np.stack([1 - fraction, fraction], axis=1)[:, np.newaxis, :]).reshape(
+            n_points, -1)
+
+    # Corners of the stencils of the previous dimensions were repeated, thus broadcast the keys to a common shape
+    stencil_size = weights.shape[1]
+    keys = {name: np.broadcast_to(key, (n_points, stencil_size)).ravel() for name, key in keys.items()}
+    _, index, inverse = np.unique(np.stack(list(keys.values()), axis=1), axis=0, return_index=True,
+                                  return_inverse=True)
+    sel_dict_stencils = dict(sel_dict)
+    for name, key in keys.items():
+        if name not in resolution:
+            values = sel_dict[name].values[index // stencil_size]
+        elif name in time_names:
+            values = pd.Timestamp(origin.get(name, 0)).value + key[index] * pd.Timedelta(resolution[name]).value
+            # Keep the datetime unit of the original points (the unit of datetime64 indexers matters for interp)
+            dtype = sel_dict[name].dtype if np.issubdtype(sel_dict[name].dtype, np.datetime64) else 'datetime64[ns]'
+            values = values.astype('datetime64[ns]').astype(dtype)
+        else:
+            values = origin.get(name, 0) + key[index] * resolution[name]
+        sel_dict_stencils[name] = xarray.DataArray(values, dims=sel_dict[name].dims)
+    return sel_dict_stencils, inverse.reshape(n_points, stencil_size), weights
+
+
 def has_nan(dataarray_or_dataset):
     """
     :param dataarray_or_dataset:
@@ -246,6 +458,124 @@ def has_nan(dataarray_or_dataset):
             return False
 
 
+def interp_cmems_trajectory(downloader, parameters, sel_dict, spatial_buffer=1, method_interp='nearest',
+                            method_extrap='linear', n_workers=None):
+    """
+    Interpolate CMEMS data along a trajectory using an existing downloader object
+    :param n_workers: number of processes used for the interpolation (see maridatadownloader.parallel)
+    :return: xarray.Dataset
+    """
+    assert 'time' in sel_dict
+    assert 'longitude' in sel_dict
+    assert 'latitude' in sel_dict
+
+    time_min = min(sel_dict['time'])
+    time_max = max(sel_dict['time'])
+    lon_min = min(sel_dict['longitude'])
+    lon_max = max(sel_dict['longitude'])
+    lat_min = min(sel_dict['latitude'])
+    lat_max = max(sel_dict['latitude'])
+
+    # CMEMS data has NaN values on land pixels, thus we need to extrapolate NaN values close to the coast to make
+    # sure that we have no NaN values in the interpolated data for the trajectory
+    sub_cube = get_cmems_sub_cube(downloader, parameters, time_min, time_max, lon_min, lon_max, lat_min, lat_max,
+                                  spatial_buffer)
+    if has_nan(sub_cube):
+        sub_cube = fill_nan(sub_cube, method=method_extrap)
+    dataset_trajectory = interp_parallel(sub_cube, sel_dict, n_workers, method=method_interp)
+    return dataset_trajectory
+
+
+def interp_deduplicated(interp_func, resolution, sel_dict, method='nearest'):
+    """
+    Interpolate once per grid node of the target product and scatter the results back to the trajectory points
+
+    The cost scales with the number of distinct grid nodes visited instead of the number of points. For method
+    'nearest', every point takes the value of its nearest node, which is exact if resolution matches the grid of the
+    product. For method 'linear', the values at the corners of the enclosing cell are combined using the multilinear
+    weights of the point, which is exact if the grid of the product is a subset of the grid defined by resolution.
+    Other interpolation methods are not supported.
+
+    :param interp_func: callable which takes a sel_dict as keyword argument and returns an xarray.Dataset
+    :param resolution: see get_trajectory_stencils. If None, interp_func is applied to all points.
+    :param sel_dict: dict of 1-D xarray.DataArray with a common dimension, as returned by get_trajectory_dict
+    :param method: interpolation method used by interp_func, i.e. 'nearest' or 'linear'
+    :return: xarray.Dataset with the coordinates of the original points
+    """
+    if not resolution:
+        return interp_func(sel_dict=sel_dict)
+    sel_dict_stencils, inverse, weights = get_trajectory_stencils(sel_dict, resolution, method=method)
+    dim = next(indexer.dims[0] for indexer in sel_dict.values() if isinstance(indexer, xarray.DataArray))
+    logger.info(f"Interpolate {inverse.max() + 1} grid nodes for {inverse.shape[0]} trajectory points")
+    dataset_nodes = interp_func(sel_dict=sel_dict_stencils)
+    dataset = dataset_nodes.isel({dim: inverse[:, 0]})
+    if inverse.shape[1] > 1:
+        # Weighted sum over the stencil. Corners with zero weight are skipped so that NaN values beyond the edges of
+        # the product don't propagate.
+        data_vars = [name for name, variable in dataset.data_vars.items()
+                     if dim in variable.dims and np.issubdtype(variable.dtype, np.number)]
+        dataset_weighted = 0
+        for corner in range(inverse.shape[1]):
+            weight = xarray.DataArray(weights[:, corner], dims=dim)
+            dataset_corner = dataset_nodes[data_vars].isel({dim: inverse[:, corner]})
+            dataset_weighted = dataset_weighted + (dataset_corner * weight).where(weight > 0, 0)
+        dataset = dataset.assign({name: dataset_weighted[name].astype(dataset[name].dtype, copy=False)
+                                  if np.issubdtype(dataset[name].dtype, np.floating) else dataset_weighted[name]
+                                  for name in data_vars})
+    # Restore the coordinates of the original points
+    coords = {name: (dim, indexer.values) for name, indexer in sel_dict.items()
+              if isinstance(indexer, xarray.DataArray) and name in dataset.coords and dataset[name].dims == (dim,)}
+    if dim in dataset.indexes:
+        dataset = dataset.drop_vars(dim)
+    return dataset.assign_coords(coords)
+
+
+def interp_fleet_blocks(df_fleet, blocks, interp_func, table=None, source=None):
+    """
+    Apply interp_func block by block and insert the results into the rows of the original row order
+    :param df_fleet: pandas.Dataframe as returned by read_fleet_positions
+    :param blocks: list of row indices as returned by get_fleet_blocks
+    :param interp_func: callable which takes a sel_dict as keyword argument and returns an xarray.Dataset
+    :param table: TrajectoryTable with one row per row of df_fleet (default: new table)
+    :param source: source identifier passed to TrajectoryTable.insert
+    :return: TrajectoryTable
+    """
+    if table is None:
+        table = TrajectoryTable(len(df_fleet))
+    for rows in blocks:
+        sel_dict = get_trajectory_dict(df_fleet.iloc[rows])
+        dataset = interp_func(sel_dict=sel_dict)
+        table.insert(dataset, rows=rows, source=source)
+    return table
+
+
+def interp_gfs_trajectory(downloader, parameters, sel_dict, height_above_ground=10, method_interp='nearest'):
+    """
+    Interpolate GFS data along a trajectory using an existing downloader object
+    :return: xarray.Dataset
+    """
+    sel_dict = dict(sel_dict)
+    sel_dict['time1'] = sel_dict['time']
+    if height_above_ground:
+        sel_dict['height_above_ground'] = height_above_ground
+        sel_dict['height_above_ground2'] = height_above_ground
+
+    return downloader.download(parameters=parameters, sel_dict=sel_dict, interpolate=True, method=method_interp)
+
+
+def read_fleet_positions(csv_files):
+    """
+    :param csv_files: list of csv files, one trajectory per file
+    :return: pandas.Dataframe with the additional column 'track' (index of the csv file)
+    """
+    data_frames = []
+    for track, csv_file in enumerate(csv_files):
+        df_positions = read_hf_data_positions(csv_file)
+        df_positions['track'] = track
+        data_frames.append(df_positions)
+    return pd.concat(data_frames, ignore_index=True)
+
+
 def read_hf_data_positions(csv_file):
     """
     :param csv_file:
@@ -262,3 +592,20 @@ def read_hf_data_positions(csv_file):
     df_positions.loc[is_south, 'latitude'] = df_positions['latitude'][is_south] * -1
     df_positions.drop(columns=['direction_y', 'direction_x'], inplace=True)
     return df_positions
+
+
+def _allocate_column(n_rows, dtype):
+    """:return: numpy array of n_rows missing values (NaN, NaT or None) which can hold values of dtype"""
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'mM':
+        return np.full(n_rows, np.datetime64('NaT') if dtype.kind == 'M' else np.timedelta64('NaT'), dtype=dtype)
+    if dtype.kind in 'OSU':
+        return np.full(n_rows, None, dtype=object)
+    if dtype.kind not in 'fc':
+        dtype = np.result_type(dtype, np.float64)
+    return np.full(n_rows, np.nan, dtype=dtype)
+
+
+def _round_half_down(values):
+    # Ties are resolved towards the lower grid node, consistent with nearest-neighbour interpolation of scipy
+    return np.ceil(values - 0.5).astype('int64')
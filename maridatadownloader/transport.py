@@ -0,0 +1,81 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from maridatadownloader.scheduler import get_host
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPTransport:
+    """
+    Shared HTTP transport with pooled sessions
+
+    Anonymous requests use one session per host so that keep-alive connections (and TLS sessions) are reused across
+    requests instead of opening a new connection per request. Downloaders which need authentication (cookies or
+    credentials stored on the session) create their own session via `create_session`, which is configured the same
+    way, and keep it for their lifetime.
+    """
+    def __init__(self, pool_maxsize=10, connect_timeout=10, read_timeout=120, compression=True):
+        """
+        :param pool_maxsize: maximum number of connections kept alive per host
+        :param connect_timeout: timeout in seconds for establishing a connection
+        :param read_timeout: timeout in seconds between two bytes received from the server
+        :param compression: accept gzip/deflate compressed responses
+        """
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.compression = compression
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        """(connect, read) timeout tuple as accepted by requests"""
+        return self.connect_timeout, self.read_timeout
+
+    def close(self):
+        """Close all pooled sessions"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def create_session(self):
+        """:return: new requests.Session using the pool and compression settings of the transport"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate' if self.compression else 'identity'
+        return session
+
+    def get(self, url, **kwargs):
+        """GET url using the pooled session of its host (and the timeouts of the transport)"""
+        kwargs.setdefault('timeout', self.timeout)
+        return self.get_session(url).get(url, **kwargs)
+
+    def get_session(self, url):
+        """:return: pooled requests.Session for the host of url (must not be used for authenticated requests)"""
+        host = get_host(url)
+        with self._lock:
+            if host not in self._sessions:
+                logger.debug(f"Create pooled session for '{host}'")
+                self._sessions[host] = self.create_session()
+            return self._sessions[host]
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+    """:return: HTTPTransport shared by all downloaders which are not given a dedicated transport"""
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = HTTPTransport()
+        return _default_transport
@@ -2,8 +2,8 @@ from copy import deepcopy
 from datetime import datetime, timedelta, timezone
 
 import xarray
-from numpy import datetime64, ndarray
-from pandas import Timestamp
+from numpy import datetime64, isnan, ndarray
+from pandas import DatetimeIndex, Timestamp
 
 
 def convert_datetime(dt64):
@@ -27,6 +27,45 @@ def convert_datetime(dt64):
         return None
 
 
+def get_isel_dict_enclosing(dataset, sel_dict):
+    """
+    Index-based bounding box of the vectorized indexers in sel_dict. The range of the indexers is extended to the
+    next coordinate value of the dataset on each side (like ffill/bfill), thus the box contains the grid nodes
+    needed for nearest-neighbour selection and linear interpolation whatever the grid spacing of the dataset is.
+
+    :param dataset: xarray.Dataset
+    :param sel_dict: dict of indexers. Only xarray.DataArray indexers of monotonic dimensions are considered.
+    :return: dict with a slice of positional indices per dimension
+    """
+    isel_dict = {}
+    for dim, indexer in sel_dict.items():
+        if not isinstance(indexer, xarray.DataArray) or dim not in dataset.dims or dim not in dataset.indexes:
+            continue
+        index = dataset.indexes[dim]
+        if isinstance(index, DatetimeIndex):
+            value_min, value_max = get_start_and_end_time(indexer)
+            # The dataset coordinates are timezone-unaware
+            value_min = Timestamp(value_min.replace(tzinfo=None))
+            value_max = Timestamp(value_max.replace(tzinfo=None))
+        else:
+            value_min = indexer.min().values.item()
+            value_max = indexer.max().values.item()
+            if isnan(value_min) or isnan(value_max):
+                continue
+        descending = index.is_monotonic_decreasing and not index.is_monotonic_increasing
+        if descending:
+            index = index[::-1]
+        elif not index.is_monotonic_increasing:
+            continue
+        # Last coordinate value <= value_min and first coordinate value >= value_max
+        start = max(index.searchsorted(value_min, side='right') - 1, 0)
+        stop = min(index.searchsorted(value_max, side='left') + 1, index.size)
+        if descending:
+            start, stop = index.size - stop, index.size - start
+        isel_dict[dim] = slice(int(start), int(stop))
+    return isel_dict
+
+
 def get_sel_dict_orthogonal(sel_dict, buffer_space=1.0, buffer_hours=3):
     """
     :param sel_dict:
@@ -36,12 +75,12 @@ def get_sel_dict_orthogonal(sel_dict, buffer_space=1.0, buffer_hours=3):
     """
     sel_dict_orthogonal = deepcopy(sel_dict)
     if 'longitude' in sel_dict_orthogonal and isinstance(sel_dict_orthogonal['longitude'], xarray.DataArray):
-        lon_min = min(sel_dict_orthogonal['longitude']).values.item() - buffer_space
-        lon_max = max(sel_dict_orthogonal['longitude']).values.item() + buffer_space
+        lon_min = sel_dict_orthogonal['longitude'].min().values.item() - buffer_space
+        lon_max = sel_dict_orthogonal['longitude'].max().values.item() + buffer_space
         sel_dict_orthogonal['longitude'] = slice(lon_min, lon_max)
     if 'latitude' in sel_dict_orthogonal and isinstance(sel_dict_orthogonal['latitude'], xarray.DataArray):
-        lat_min = min(sel_dict_orthogonal['latitude']).values.item() - buffer_space
-        lat_max = max(sel_dict_orthogonal['latitude']).values.item() + buffer_space
+        lat_min = sel_dict_orthogonal['latitude'].min().values.item() - buffer_space
+        lat_max = sel_dict_orthogonal['latitude'].max().values.item() + buffer_space
         sel_dict_orthogonal['latitude'] = slice(lat_min, lat_max)
     # Make datetime objects timezone-unaware because the xarray.Dataset.sel method otherwise throws an error
     if 'time' in sel_dict_orthogonal and isinstance(sel_dict_orthogonal['time'], xarray.DataArray):
@@ -90,8 +129,9 @@ def get_start_and_end_time(time_):
         # Notes:
         # - if datetime objects are timezone aware xarray.DataArray will parse them into pandas.Timestamp objects
         # - if datetime objects are not timezone aware xarray.DataArray will parse them into numpy.datetime64 objects
-        time_start = min(time_).values
-        time_end = max(time_).values
+        # Note: use the reductions of xarray instead of the builtins min/max which iterate over all elements
+        time_start = time_.min().values
+        time_end = time_.max().values
         if isinstance(time_start, ndarray):
             time_start = time_start.item()
             if isinstance(time_start, Timestamp):
@@ -1,16 +1,24 @@
 import logging
+import threading
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import datetime, timezone, timedelta, time
+from functools import partial
 from math import ceil
 
 # import dask
+import numpy
+import pandas
 import xarray
-from pydap.client import open_url
-from pydap.cas.get_cookies import setup_session
-from xarray.backends import NetCDF4DataStore
 
+from maridatadownloader.aggregation import StreamingAggregator
 from maridatadownloader.base import DownloaderBase
-from maridatadownloader.utils import get_sel_dict_orthogonal, get_start_and_end_time, make_timezone_aware
+from maridatadownloader.coalescing import RequestCoalescer, get_coalescing_box
+from maridatadownloader.derived import compute_derived_variable, get_components
+from maridatadownloader.parallel import interp_parallel
+from maridatadownloader.prefetch import WindowPrefetcher, prefetchable
+from maridatadownloader.utils import (get_isel_dict_enclosing, get_sel_dict_orthogonal, get_start_and_end_time,
+                                     make_timezone_aware)
 
 logger = logging.getLogger(__name__)
 
@@ -46,10 +54,7 @@ class DownloaderXarray(DownloaderBase):
         self.platform = platform
         self.dataset = None
         self.filename_or_obj = self.get_filename_or_obj(**kwargs)
-        if 'chunks' in kwargs:
-            self.chunks = kwargs['chunks']
-        else:
-            self.chunks = None
+        self._init_options(**kwargs)
         self.open_dataset()
 
     def check_connection(self):
@@ -59,6 +64,20 @@ class DownloaderXarray(DownloaderBase):
         except Exception:
             return False
 
+    def declare_windows(self, windows, parameters=None, sel_dict=None, interpolate=False, **kwargs):
+        """
+        Declare the time windows of the upcoming download calls so that they are prefetched in the background
+        (requires the window_prefetch option, see maridatadownloader.prefetch)
+
+        :param windows: list of (start, end) tuples
+        :param parameters: str or list, as passed to download
+        :param sel_dict: dict, as passed to download. The time slice is replaced by the windows.
+        """
+        assert self.window_prefetcher is not None, "window prefetching is not enabled (window_prefetch)"
+        self.window_prefetcher.declare(windows, parameters=parameters, sel_dict=sel_dict, interpolate=interpolate,
+                                       **kwargs)
+
+    @prefetchable
     def download(self, parameters=None, sel_dict=None, isel_dict=None, file_out=None, interpolate=False, **kwargs):
         """
         :param parameters: str or list
@@ -76,6 +95,13 @@ class DownloaderXarray(DownloaderBase):
         :param kwargs:
             Additional keyword arguments are passed to the corresponding method sel, isel or interp.
             For details on which arguments can be used check the references below.
+            Special keyword arguments for aggregation (see _apply_aggregation):
+             - resample: dict, temporal resampling, e.g. {'time': '1D'}
+             - coarsen: dict, spatial coarsening, e.g. {'latitude': 4, 'longitude': 4}
+             - aggregation: str, reduction method, e.g. 'mean' (default), 'min', 'max', 'sum'
+             - aggregation_chunk_size: int, number of time steps loaded at once (default: 24)
+            Special keyword argument for derived variables (see _apply_derived):
+             - derived: str or list, e.g. ['wind_speed', 'wind_direction'] (see maridatadownloader.derived)
         :return: xarray.Dataset
 
         References:
@@ -85,6 +111,10 @@ class DownloaderXarray(DownloaderBase):
          - https://docs.xarray.dev/en/latest/user-guide/interpolation.html
          - https://docs.xarray.dev/en/latest/generated/xarray.Dataset.interp.html
         """
+        aggregation_kwargs = self._pop_aggregation_kwargs(kwargs)
+        derived = self._pop_derived(kwargs)
+        requested_parameters = parameters
+        parameters = self._get_derived_parameters(parameters, derived)
         coord_dict, subsetting_method = self._prepare_download(sel_dict, isel_dict, interpolate)
 
         try:
@@ -92,16 +122,70 @@ class DownloaderXarray(DownloaderBase):
         except NotImplementedError:
             dataset = self.dataset
 
-        dataset_sub = self._apply_subsetting(dataset, parameters, coord_dict, subsetting_method, **kwargs)
+        dataset = self._prefetch_orthogonal(dataset, parameters, coord_dict, subsetting_method, kwargs.get('method'))
+        if aggregation_kwargs:
+            # Keep the selection lazy so that it is aggregated chunk by chunk (the coalesced fetch loads the union)
+            dataset_sub = self._apply_subsetting(dataset, parameters, coord_dict, subsetting_method, **kwargs)
+        else:
+            dataset_sub = self._apply_subsetting_coalesced(dataset, parameters, coord_dict, subsetting_method,
+                                                           **kwargs)
+        dataset_sub = self._apply_derived(dataset_sub, derived, requested_parameters)
+
+        try:
+            dataset_sub = self.postprocessing(dataset_sub)
+        except NotImplementedError:
+            pass
+
+        if aggregation_kwargs:
+            dataset_sub = self._apply_aggregation(dataset_sub, **aggregation_kwargs)
+
+        dataset_sub = self.apply_encoding_policy(dataset_sub)
+
+        if file_out:
+            logger.info(f"Save dataset to '{file_out}'")
+            self.save_dataset(dataset_sub, file_out)
+
+        return dataset_sub
+
+    def download_stations(self, latitudes, longitudes, parameters=None, sel_dict=None, station_ids=None,
+                          file_out=None):
+        """
+        Extract time series at fixed stations (e.g. wind farms, buoys, ports)
+
+        Each station is assigned to its nearest grid cell. Stations falling into the same grid cell are merged,
+        and only the grid columns of these cells are fetched (one read per cell) instead of the surrounding map.
+
+        :param latitudes: list or numpy.ndarray
+        :param longitudes: list or numpy.ndarray
+        :param parameters: str or list
+        :param sel_dict: dict
+            Coordinate selection by value for the remaining dimensions, e.g. {'time': slice('2023-11-01T00:00:00',
+            '2023-12-01T00:00:00')}
+        :param station_ids: list of station identifiers. Defaults to 0...N-1
+        :param file_out:
+            File name used to save the dataset as NetCDF file. No file is saved without specifying file_out
+        :return: xarray.Dataset with dimensions (station, time, ...). The coordinates 'latitude' and 'longitude' are
+            the station positions, 'grid_latitude' and 'grid_longitude' the positions of the grid cells used.
+        """
+        latitudes, longitudes, station_ids = self._prepare_stations(latitudes, longitudes, station_ids)
+        coord_dict, _ = self._prepare_download(sel_dict)
+        try:
+            dataset = self.preprocessing(self.dataset, parameters=parameters, coord_dict=coord_dict)
+        except NotImplementedError:
+            dataset = self.dataset
+        dataset_cells, inverse = self._get_station_cells(dataset, latitudes, longitudes, parameters, coord_dict)
+        dataset_sub = self._assemble_stations(dataset_cells, inverse, latitudes, longitudes, station_ids)
 
         try:
             dataset_sub = self.postprocessing(dataset_sub)
         except NotImplementedError:
             pass
 
+        dataset_sub = self.apply_encoding_policy(dataset_sub)
+
         if file_out:
             logger.info(f"Save dataset to '{file_out}'")
-            dataset_sub.to_netcdf(file_out)
+            self.save_dataset(dataset_sub, file_out)
 
         return dataset_sub
 
@@ -131,6 +215,8 @@ class DownloaderXarray(DownloaderBase):
 
     def release_resources(self):
         """Release resources from dataset using xarray.Dataset.close()"""
+        if self.window_prefetcher is not None:
+            self.window_prefetcher.close()
         try:
             self.dataset.close()
         except Exception:
@@ -143,6 +229,70 @@ class DownloaderXarray(DownloaderBase):
             self.filename_or_obj = self.get_filename_or_obj()
         self.open_dataset()
 
+    def _apply_aggregation(self, dataset, resample=None, coarsen=None, aggregation='mean', aggregation_chunk_size=24):
+        """
+        Out-of-core aggregation: the (lazy) dataset is loaded chunk by chunk along the time dimension and each chunk
+        is reduced before the next one is loaded (see maridatadownloader.aggregation.StreamingAggregator). The
+        result is the same as reducing the full dataset at once, while only the reduced result and a single chunk
+        are held in memory.
+
+        :param resample: dict, e.g. {'time': '1D'}
+        :param coarsen: dict, e.g. {'latitude': 4, 'longitude': 4}. Incomplete windows at the boundaries are trimmed.
+        :param aggregation: name of the reduction method, e.g. 'mean', 'min', 'max', 'sum', 'median', 'std'
+        :param aggregation_chunk_size: number of steps along the chunk dimension loaded at once
+        """
+        if not resample and not coarsen:
+            return dataset
+        aggregator = StreamingAggregator(resample, coarsen, aggregation)
+        dim = aggregator.get_dim(dataset)
+        if dim is None:
+            return aggregator.aggregate(dataset.load())
+
+        size = dataset.sizes[dim]
+        logger.info(f"Aggregate in {ceil(size / aggregation_chunk_size)} chunks along '{dim}'")
+        for start in range(0, size, aggregation_chunk_size):
+            aggregator.push(dataset.isel({dim: slice(start, start + aggregation_chunk_size)}))
+        return aggregator.finish()
+
+    @staticmethod
+    def _apply_derived(dataset, derived=None, parameters=None, chunk_size=24):
+        """
+        Compute derived variables (see maridatadownloader.derived) from their components
+
+        Dask-backed datasets stay lazy so that the element-wise computation is fused into the task graph. Otherwise,
+        the components are loaded chunk by chunk along the time dimension and only the derived variables are kept
+        in memory. Components which are not part of parameters are dropped.
+
+        :param derived: list of derived variable names
+        :param parameters: parameters requested by the user (None: keep all variables)
+        :param chunk_size: number of time steps loaded at once
+        """
+        if not derived:
+            return dataset
+        components = list(dict.fromkeys(component for name in derived
+                                        for component in get_components(name, dataset.data_vars)))
+        dataset_components = dataset[components]
+
+        def compute(dataset_part):
+            return xarray.Dataset({name: compute_derived_variable(name, dataset_part) for name in derived})
+
+        dim = next((time_dim for time_dim in ['time', 'time1', 'time2'] if time_dim in dataset_components.dims), None)
+        if dataset_components.chunks:
+            dataset_derived = compute(dataset_components)
+        elif dim is None:
+            dataset_derived = compute(dataset_components.load())
+        else:
+            size = dataset_components.sizes[dim]
+            logger.info(f"Compute derived variables {derived} in {ceil(size / chunk_size)} chunks along '{dim}'")
+            parts = [compute(dataset_components.isel({dim: slice(start, start + chunk_size)}).load())
+                     for start in range(0, size, chunk_size)]
+            dataset_derived = xarray.concat(parts, dim=dim, data_vars='minimal')
+
+        if parameters:
+            parameters = [parameters] if isinstance(parameters, str) else parameters
+            dataset = dataset.drop_vars([component for component in components if component not in parameters])
+        return dataset.assign(dataset_derived.data_vars)
+
     def _apply_subsetting(self, dataset, parameters=None, coord_dict=None, subsetting_method=None, **kwargs):
         # ToDo: support xarrray.Dataset.interp_like?
         # Apply parameter subsetting
@@ -163,10 +313,145 @@ class DownloaderXarray(DownloaderBase):
         elif subsetting_method == 'isel':
             dataset_sub = dataset_sub.isel(**coord_dict, **kwargs)
         elif subsetting_method == 'interp':
-            dataset_sub = dataset_sub.interp(**coord_dict, **kwargs)
+            if self.interp_workers and self.interp_workers > 1:
+                dataset_sub = interp_parallel(dataset_sub, coord_dict, self.interp_workers, **kwargs)
+            else:
+                dataset_sub = dataset_sub.interp(**coord_dict, **kwargs)
 
         return dataset_sub
 
+    @staticmethod
+    def _assemble_stations(dataset_cells, inverse, latitudes, longitudes, station_ids):
+        """
+        :param dataset_cells: xarray.Dataset with one grid column per grid cell along the dimension 'station'
+        :param inverse: index of the grid cell of every station
+        :return: xarray.Dataset with one grid column per station
+        """
+        dataset_sub = dataset_cells.isel(station=inverse)
+        dataset_sub = dataset_sub.rename({'latitude': 'grid_latitude', 'longitude': 'grid_longitude'})
+        dataset_sub = dataset_sub.assign_coords(station=numpy.asarray(station_ids),
+                                                latitude=('station', latitudes),
+                                                longitude=('station', longitudes))
+        return dataset_sub.transpose('station', ...)
+
+    def _get_derived_parameters(self, parameters=None, derived=None):
+        """:return: parameters extended by the components of the derived variables"""
+        if not derived or not parameters:
+            return parameters
+        parameters = [parameters] if isinstance(parameters, str) else list(parameters)
+        for name in derived:
+            for component in get_components(name, self.dataset.data_vars):
+                if component not in parameters:
+                    parameters.append(component)
+        return parameters
+
+    @staticmethod
+    def _get_station_cells(dataset, latitudes, longitudes, parameters=None, coord_dict=None):
+        """
+        Merge stations located in the same grid cell and fetch one grid column per cell (one read per cell)
+
+        :param dataset: preprocessed xarray.Dataset with the dimensions 'latitude' and 'longitude'
+        :param coord_dict: coordinate selection by value for the remaining dimensions
+        :return: 2-tuple (xarray.Dataset with the grid columns along the dimension 'station', numpy array with the
+            index of the grid cell of every station)
+        """
+        if parameters:
+            dataset = dataset[[parameters] if isinstance(parameters, str) else parameters]
+        coord_dict = {key: value for key, value in (coord_dict or {}).items()
+                      if key in dataset.dims and key not in ['latitude', 'longitude']}
+        if coord_dict:
+            dataset = dataset.sel(**coord_dict)
+
+        lat_idx = dataset.indexes['latitude'].get_indexer(latitudes, method='nearest')
+        lon_idx = dataset.indexes['longitude'].get_indexer(longitudes, method='nearest')
+        cells, inverse = numpy.unique(numpy.stack([lat_idx, lon_idx], axis=1), axis=0, return_inverse=True)
+        logger.info(f"Fetch {len(cells)} grid columns for {latitudes.size} stations")
+
+        columns = [dataset.isel(latitude=i, longitude=j).load() for i, j in cells]
+        return xarray.concat(columns, dim='station'), inverse.ravel()
+
+    def _init_options(self, **kwargs):
+        """
+        Set the options shared by the xarray based downloaders. Subclasses which don't call DownloaderXarray.__init__
+        (e.g. DownloaderCopernicusMarineToolboxApi) must call this method in their constructor.
+        """
+        self.chunks = kwargs.get('chunks', None)
+        # Concurrent overlapping box requests are coalesced if a coalescing window (in seconds) is provided
+        coalesce_window = kwargs.get('coalesce_window', None)
+        self.coalescer = RequestCoalescer(coalesce_window) if coalesce_window is not None else None
+        # Maximum estimated size of the orthogonal bounding box which is prefetched before vectorized sub-setting
+        self.prefetch_max_bytes = kwargs.get('prefetch_max_bytes', 512 * 1024 ** 2)
+        # Number of processes used for interpolation along vectorized indexers (see maridatadownloader.parallel)
+        self.interp_workers = kwargs.get('interp_workers', None)
+        # The next time windows are prefetched in the background if the number of windows to fetch ahead is provided
+        window_prefetch = kwargs.get('window_prefetch', None)
+        self.window_prefetcher = None
+        if window_prefetch:
+            self.window_prefetcher = WindowPrefetcher(
+                self, n_ahead=window_prefetch, max_bytes=kwargs.get('window_prefetch_max_bytes', 256 * 1024 ** 2))
+
+    @staticmethod
+    def _pop_aggregation_kwargs(kwargs):
+        return {key: kwargs.pop(key) for key in ['resample', 'coarsen', 'aggregation', 'aggregation_chunk_size']
+                if key in kwargs}
+
+    @staticmethod
+    def _pop_derived(kwargs):
+        derived = kwargs.pop('derived', None)
+        if isinstance(derived, str):
+            derived = [derived]
+        return derived
+
+    def _prefetch_orthogonal(self, dataset, parameters=None, coord_dict=None, subsetting_method=None, method=None):
+        """
+        Two-stage sub-setting for vectorized indexing: fetch the orthogonal bounding box of the indexers in one go so
+        that the subsequent vectorized sel/interp is applied in memory instead of triggering many small remote reads.
+        The bounding box is extended to the enclosing coordinate values of the dataset (see get_isel_dict_enclosing),
+        thus the result doesn't depend on prefetching. Prefetching is skipped for interpolation methods which
+        depend on more than the enclosing grid nodes (e.g. 'cubic') and if the estimated size of the bounding box
+        exceeds self.prefetch_max_bytes.
+        """
+        if subsetting_method not in ['sel', 'interp'] or not coord_dict or not self.prefetch_max_bytes:
+            return dataset
+        if subsetting_method == 'interp' and method not in [None, 'linear', 'nearest']:
+            return dataset
+        if not any(isinstance(indexer, xarray.DataArray) for indexer in coord_dict.values()):
+            return dataset
+
+        if parameters:
+            dataset = dataset[[parameters] if isinstance(parameters, str) else parameters]
+        bbox_dict = get_isel_dict_enclosing(dataset, coord_dict)
+        if not bbox_dict:
+            return dataset
+        dataset_bbox = dataset.isel(**bbox_dict)
+        if dataset_bbox.nbytes > self.prefetch_max_bytes:
+            logger.info(f"Skip prefetching of bounding box ({dataset_bbox.nbytes / 1024 ** 2:.1f} MB)")
+            return dataset
+        logger.info(f"Prefetch bounding box ({dataset_bbox.nbytes / 1024 ** 2:.1f} MB)")
+        return dataset_bbox.load()
+
+    def _apply_subsetting_coalesced(self, dataset, parameters=None, coord_dict=None, subsetting_method=None,
+                                    **kwargs):
+        """
+        Apply the sub-setting via the request coalescer (if enabled) so that concurrent overlapping box requests
+        are served by a single fetch. Other requests are passed to _apply_subsetting directly.
+        """
+        coalescing_box = None
+        if self.coalescer is not None and subsetting_method == 'sel' and coord_dict:
+            dims = (dataset[parameters] if parameters else dataset).dims
+            coalescing_box = get_coalescing_box({key: value for key, value in coord_dict.items() if key in dims})
+        if coalescing_box is None:
+            return self._apply_subsetting(dataset, parameters, coord_dict, subsetting_method, **kwargs)
+
+        box, scalars = coalescing_box
+        key = (id(self.dataset), repr(parameters), repr(sorted(scalars.items())), tuple(sorted(box)),
+               repr(sorted(kwargs.items())))
+
+        def fetch(union_box):
+            return self._apply_subsetting(dataset, parameters, {**scalars, **union_box}, 'sel', **kwargs).load()
+
+        return self.coalescer.fetch(key, box, fetch)
+
     def _prepare_download(self, sel_dict=None, isel_dict=None, interpolate=False):
         # Make a copy of the sel/isel dict because key-value pairs might be deleted from it
         coord_dict = {}
@@ -184,6 +469,15 @@ class DownloaderXarray(DownloaderBase):
             subsetting_method = 'interp'
         return coord_dict, subsetting_method
 
+    @staticmethod
+    def _prepare_stations(latitudes, longitudes, station_ids=None):
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        assert latitudes.shape == longitudes.shape, "latitudes and longitudes must have the same length"
+        if station_ids is None:
+            station_ids = numpy.arange(latitudes.size)
+        return latitudes, longitudes, station_ids
+
 
 class DownloaderXarrayGFS(DownloaderXarray):
     """
@@ -199,32 +493,54 @@ class DownloaderXarrayGFS(DownloaderXarray):
     def __init__(self, username=None, password=None, **kwargs):
         self.model_cycles = [time(0), time(6), time(12), time(18)]
         self.forecast_times = [time(0), time(3), time(6), time(9), time(12), time(15), time(18), time(21)]
+        # State (fetched pieces, aggregation) of archived data requests which failed partially
+        # (see _download_archived_data). Only the most recently used requests are kept.
+        self._partial_requests = OrderedDict()
+        self._partial_requests_lock = threading.Lock()
+        self.max_partial_requests = kwargs.get('max_partial_requests', 4)
+        # Engine used to open archived GFS files: 'netcdf4' opens a new connection per file, 'pydap' (opt-in)
+        # reuses the pooled HTTP sessions of the transport
+        self.opendap_engine = kwargs.get('opendap_engine', 'netcdf4')
         super().__init__('gfs', username=username, password=password, **kwargs)
 
+    @prefetchable
     def download(self, parameters=None, sel_dict=None, isel_dict=None, file_out=None, interpolate=False, **kwargs):
         # Note: we do not support index selection (isel_dict) for archived GFS data by choice
         # FIXME: if multiple time coordinates (time, time1, ...) are provided, should we extract the longest overall
         #        time interval?
         if sel_dict and not isel_dict:
-            if 'time' in sel_dict:
-                time_ = sel_dict['time']
-            elif 'time1' in sel_dict:
-                time_ = sel_dict['time1']
-            elif 'time2' in sel_dict:
-                time_ = sel_dict['time2']
-            else:
-                time_ = None
-            if time_ is not None:
-                time_start, time_end = get_start_and_end_time(time_)
-                time_start = make_timezone_aware(time_start)
-                time_end = make_timezone_aware(time_end)
-                assert time_start <= time_end, "Start time must be smaller or equal to end time"
-                if time_end < (datetime.now(timezone.utc) - timedelta(days=3)):
-                    print("Access archived GFS data")
-                    return self._download_archived_data(time_start, time_end, parameters, sel_dict, file_out,
-                                                        interpolate, **kwargs)
+            time_window = self._get_time_window(sel_dict)
+            if time_window is not None and self._is_archived(time_window[1]):
+                print("Access archived GFS data")
+                return self._download_archived_data(*time_window, parameters, sel_dict, file_out, interpolate,
+                                                    **kwargs)
         return super().download(parameters, sel_dict, isel_dict, file_out, interpolate, **kwargs)
 
+    def download_stations(self, latitudes, longitudes, parameters=None, sel_dict=None, station_ids=None,
+                          file_out=None):
+        """
+        See DownloaderXarray.download_stations. Archived time windows are fetched file by file (one read per grid
+        cell and file). Time windows which start before the first time step of the 'Best' aggregation but end
+        within it are not supported.
+        """
+        time_window = self._get_time_window(sel_dict) if sel_dict else None
+        if time_window is None:
+            return super().download_stations(latitudes, longitudes, parameters, sel_dict, station_ids, file_out)
+        if self._is_archived(time_window[1]):
+            logger.info("Access archived GFS data")
+            return self._download_stations_archived(*time_window, latitudes, longitudes, parameters, sel_dict,
+                                                    station_ids, file_out)
+        dataset = self.dataset
+        if parameters:
+            dataset = dataset[[parameters] if isinstance(parameters, str) else parameters]
+        time_dims = [dim for dim in dataset.dims if dim.startswith('time')]
+        if time_dims:
+            time_best = max(pandas.Timestamp(dataset[dim].values.min()) for dim in time_dims)
+            if time_window[0] < make_timezone_aware(time_best.to_pydatetime()):
+                raise ValueError(f"The time window starts before the first time step ({time_best}) of the GFS 'Best' "
+                                 f"aggregation but ends after the archive. Split the request at this time step.")
+        return super().download_stations(latitudes, longitudes, parameters, sel_dict, station_ids, file_out)
+
     def get_filename_or_obj(self, **kwargs):
         return 'https://thredds.ucar.edu/thredds/dodsC/grib/NCEP/GFS/Global_0p25deg/Best'
 
@@ -264,22 +580,12 @@ class DownloaderXarrayGFS(DownloaderXarray):
             dataset = dataset.rename({'height_above_ground2': 'height_above_ground'})
         return dataset
 
-    def _download_archived_data(self, time_start, time_end, parameters=None, sel_dict={}, file_out=None,
-                                interpolate=False, **kwargs):
-        # Check if vectorized indexing should be applied. If yes, create a sel_dict for orthogonal indexing first
-        sel_dict_orthogonal = get_sel_dict_orthogonal(sel_dict)
-        # Merge datasets from different urls
-        self.urls = self._get_urls_time_window(time_start, time_end)
-        datasets = []
-        for url in self.urls:
-            self.open_dataset(url)
-            dataset_temp = super().download(parameters=parameters, sel_dict=sel_dict_orthogonal, file_out=None,
-                                            interpolate=False)
-            datasets.append(dataset_temp)
-        dataset = xarray.concat(datasets, dim="time")
-
-        # Because of possible coordinate renaming in self.postprocessing, we need to make sure that the original
-        # indexers are considered in the subsequent sub-setting process
+    @staticmethod
+    def _add_renamed_indexers(sel_dict):
+        """
+        Because of possible coordinate renaming in self.postprocessing, we need to make sure that the original
+        indexers are considered in the subsequent sub-setting process
+        """
         if 'time1' in sel_dict and 'time' not in sel_dict:
             sel_dict['time'] = sel_dict['time1']
         if 'time2' in sel_dict and 'time' not in sel_dict:
@@ -293,19 +599,156 @@ class DownloaderXarrayGFS(DownloaderXarray):
         if 'height_above_ground2' in sel_dict and 'height_above_ground' not in sel_dict:
             sel_dict['height_above_ground'] = sel_dict['height_above_ground2']
 
-        # Download
+    def _download_archived_data(self, time_start, time_end, parameters=None, sel_dict={}, file_out=None,
+                                interpolate=False, **kwargs):
+        aggregation_kwargs = self._pop_aggregation_kwargs(kwargs)
+        derived = self._pop_derived(kwargs)
+        requested_parameters = parameters
+        parameters = self._get_derived_parameters(parameters, derived)
+        # Check if vectorized indexing should be applied. If yes, create a sel_dict for orthogonal indexing first
+        sel_dict_orthogonal = get_sel_dict_orthogonal(sel_dict)
+        # Without interpolation and vectorized indexers, the derived variables are computed per url so that the
+        # components are never kept in memory for the whole time window
+        derived_per_url = None
+        if derived and not interpolate and not any(isinstance(value, xarray.DataArray) for value in sel_dict.values()):
+            derived_per_url = derived
+        self._add_renamed_indexers(sel_dict)
         coord_dict, subsetting_method = self._prepare_download(sel_dict, interpolate=interpolate)
-        dataset_sub = self._apply_subsetting(dataset, parameters, coord_dict, subsetting_method, **kwargs)
+
+        def select(datasets):
+            dataset = xarray.concat(datasets, dim="time")
+            if derived_per_url:
+                parameters_sub = parameters
+                if parameters:
+                    parameters_sub = [parameter for parameter in dataset.data_vars
+                                      if parameter in parameters or parameter in derived_per_url]
+                return self._apply_subsetting(dataset, parameters_sub, coord_dict, subsetting_method, **kwargs)
+            dataset_sub = self._apply_subsetting(dataset, parameters, coord_dict, subsetting_method, **kwargs)
+            return self._apply_derived(dataset_sub, derived, requested_parameters)
+
+        # The urls are fetched via the scheduler. Pieces which have already been fetched by a previous (failed) call
+        # with the same request are reused.
+        self.urls = self._get_urls_time_window(time_start, time_end)
+        request_key = (tuple(self.urls), repr(parameters), repr(sel_dict_orthogonal), repr(derived_per_url),
+                       repr(aggregation_kwargs))
+        state = self._get_partial_request(request_key)
+        fetch_func = partial(self._download_url, parameters=parameters, sel_dict=sel_dict_orthogonal,
+                             derived=derived_per_url, requested_parameters=requested_parameters)
+        if aggregation_kwargs and not interpolate and not any(isinstance(value, (list, numpy.ndarray, xarray.DataArray))
+                                                              for value in sel_dict.values()):
+            # Fetch and aggregate the urls group by group so that the full resolution data of the whole time window
+            # is never held in memory. A resumed request continues after the groups which have been aggregated.
+            if state['aggregator'] is None:
+                state['aggregator'] = StreamingAggregator(aggregation_kwargs.get('resample'),
+                                                          aggregation_kwargs.get('coarsen'),
+                                                          aggregation_kwargs.get('aggregation', 'mean'))
+            chunk_size = aggregation_kwargs.get('aggregation_chunk_size', 24)
+            logger.info(f"Aggregate {len(self.urls)} urls in groups of {chunk_size}")
+            for start in range(state['n_done'], len(self.urls), chunk_size):
+                urls = self.urls[start:start + chunk_size]
+                state['aggregator'].push(select(self.scheduler.fetch_all(urls, fetch_func,
+                                                                         completed=state['completed'])))
+                for url in urls:
+                    state['completed'].pop(url, None)
+                state['n_done'] = start + len(urls)
+            dataset_sub = state['aggregator'].finish()
+        else:
+            dataset_sub = select(self.scheduler.fetch_all(self.urls, fetch_func, completed=state['completed']))
+            if aggregation_kwargs:
+                dataset_sub = self._apply_aggregation(dataset_sub, **aggregation_kwargs)
+        with self._partial_requests_lock:
+            # The state might have been evicted by a concurrent request in the meantime
+            self._partial_requests.pop(request_key, None)
+        dataset_sub = self.apply_encoding_policy(dataset_sub)
+
+        if file_out:
+            logger.info(f"Save dataset to '{file_out}'")
+            self.save_dataset(dataset_sub, file_out)
+
+        return dataset_sub
+
+    def _download_stations_archived(self, time_start, time_end, latitudes, longitudes, parameters=None, sel_dict=None,
+                                    station_ids=None, file_out=None):
+        latitudes, longitudes, station_ids = self._prepare_stations(latitudes, longitudes, station_ids)
+        sel_dict = dict(sel_dict)
+        self._add_renamed_indexers(sel_dict)
+        urls = self._get_urls_time_window(time_start, time_end)
+        pieces = self.scheduler.fetch_all(urls, partial(self._download_url_stations, latitudes=latitudes,
+                                                        longitudes=longitudes, parameters=parameters,
+                                                        sel_dict=sel_dict))
+        # The grid is the same for all files, thus the stations are assigned to the same grid cells
+        dataset_cells = xarray.concat([dataset for dataset, _ in pieces], dim='time')
+        dataset_sub = self._assemble_stations(dataset_cells, pieces[0][1], latitudes, longitudes, station_ids)
+        dataset_sub = self.apply_encoding_policy(dataset_sub)
 
         if file_out:
             logger.info(f"Save dataset to '{file_out}'")
-            dataset_sub.to_netcdf(file_out)
+            self.save_dataset(dataset_sub, file_out)
 
-        # Reset to default forecast dataset so subsequent calls work as expected
-        self.set_filename_or_obj()
+        return dataset_sub
+
+    def _download_url(self, url, parameters=None, sel_dict=None, derived=None, requested_parameters=None):
+        """
+        Download the (orthogonal) selection from a single archived GFS file
 
+        :param derived: derived variables computed from the selection (see _apply_derived)
+        :param requested_parameters: parameters kept besides the derived variables
+        """
+        dataset = self._open_url(url)
+        try:
+            coord_dict, subsetting_method = self._prepare_download(sel_dict)
+            dataset_sub = self.preprocessing(dataset, parameters=parameters, coord_dict=coord_dict)
+            dataset_sub = self._apply_subsetting(dataset_sub, parameters, coord_dict, subsetting_method)
+            dataset_sub = self._apply_derived(self.postprocessing(dataset_sub), derived, requested_parameters).load()
+        finally:
+            dataset.close()
         return dataset_sub
 
+    def _download_url_stations(self, url, latitudes, longitudes, parameters=None, sel_dict=None):
+        """
+        Download the grid columns of the stations from a single archived GFS file
+
+        :return: 2-tuple, see _get_station_cells
+        """
+        dataset = self._open_url(url)
+        try:
+            coord_dict, _ = self._prepare_download(sel_dict)
+            dataset_sub = self.postprocessing(self.preprocessing(dataset, parameters=parameters, coord_dict=coord_dict))
+            return self._get_station_cells(dataset_sub, latitudes, longitudes, parameters, coord_dict)
+        finally:
+            dataset.close()
+
+    def _get_partial_request(self, request_key):
+        """
+        :return: state of a (resumed) archived data request. The least recently used states are evicted if there
+            are more than self.max_partial_requests.
+        """
+        with self._partial_requests_lock:
+            if request_key in self._partial_requests:
+                self._partial_requests.move_to_end(request_key)
+            else:
+                self._partial_requests[request_key] = {'completed': {}, 'aggregator': None, 'n_done': 0}
+                while len(self._partial_requests) > max(self.max_partial_requests, 1):
+                    evicted_key, _ = self._partial_requests.popitem(last=False)
+                    logger.info(f"Discard the pieces of a partially completed request ({len(evicted_key[0])} urls)")
+            return self._partial_requests[request_key]
+
+    def _get_time_window(self, sel_dict):
+        """:return: 2-tuple of timezone-aware datetime objects (start and end time) or None"""
+        if 'time' in sel_dict:
+            time_ = sel_dict['time']
+        elif 'time1' in sel_dict:
+            time_ = sel_dict['time1']
+        elif 'time2' in sel_dict:
+            time_ = sel_dict['time2']
+        else:
+            return None
+        time_start, time_end = get_start_and_end_time(time_)
+        time_start = make_timezone_aware(time_start)
+        time_end = make_timezone_aware(time_end)
+        assert time_start <= time_end, "Start time must be smaller or equal to end time"
+        return time_start, time_end
+
     def _get_url(self, datetime_obj):
         """E.g. https://thredds.rda.ucar.edu/thredds/catalog/dodsC/files/g/ds084.1/2023/20230501/gfs.0p25.2023050100
         .f000.grib2"""
@@ -333,6 +776,14 @@ class DownloaderXarrayGFS(DownloaderXarray):
                'gfs.0p25.' + year + month + day + hour + '.' + forecast_time + '.grib2')
         return url
 
+    def _get_url_model_cycle(self, reftime):
+        """E.g. https://thredds.ucar.edu/thredds/dodsC/grib/NCEP/GFS/Global_0p25deg/GFS_Global_0p25deg_20231124_0600
+        .grib2"""
+        assert reftime.time() in self.model_cycles, f"'{reftime}' is not a GFS model cycle"
+        url = ('https://thredds.ucar.edu/thredds/dodsC/grib/NCEP/GFS/Global_0p25deg/GFS_Global_0p25deg_' +
+               reftime.strftime('%Y%m%d_%H%M') + '.grib2')
+        return url
+
     def _get_urls_time_window(self, time_start, time_end):
         """
         Return a list of urls for the specified time interval. If time_start and time_end coincide exactly with the
@@ -350,6 +801,20 @@ class DownloaderXarrayGFS(DownloaderXarray):
             urls.append(self._get_url(time_tmp))
         return urls
 
+    @staticmethod
+    def _is_archived(time_end):
+        """:return: True if a time window ending at time_end is only available from the archive"""
+        return time_end < (datetime.now(timezone.utc) - timedelta(days=3))
+
+    def _open_url(self, url):
+        """Open a single archived GFS file"""
+        if self.opendap_engine == 'pydap':
+            filename_or_obj = xarray.backends.PydapDataStore.open(url, session=self.transport.get_session(url),
+                                                                  timeout=self.transport.read_timeout)
+        else:
+            filename_or_obj = url
+        return xarray.open_dataset(filename_or_obj, decode_coords="all", chunks=self.chunks)
+
 
 class DownloaderXarrayCMEMS(DownloaderXarray):
     """
@@ -371,6 +836,8 @@ class DownloaderXarrayCMEMS(DownloaderXarray):
         """
         self.product = product
         self.product_type = product_type
+        # Authenticated session, created on first use and reused for all products
+        self._session = None
         super().__init__('cmems', username=username, password=password, **kwargs)
         # https://marine.copernicus.eu/user-corner/user-notification-service/transition-marine-data-store
         msg = (f"The class 'DownloaderOpendapCMEMS' (renamed to 'DownloaderXarrayCMEMS') should not be used any more "
@@ -379,15 +846,22 @@ class DownloaderXarrayCMEMS(DownloaderXarray):
         raise DeprecationWarning(msg)
 
     def get_filename_or_obj(self, **kwargs):
+        # Import pydap lazily, it is only needed for this (deprecated) downloader
+        from pydap.cas.get_cookies import setup_session
+        from pydap.client import open_url
+
         assert self.product
         assert self.product_type
-        cas_url = 'https://cmems-cas.cls.fr/cas/login'
-        session = setup_session(cas_url, self.username, self.password)
-        session.cookies.set("CASTGC", session.cookies.get_dict()['CASTGC'])
+        if self._session is None:
+            cas_url = 'https://cmems-cas.cls.fr/cas/login'
+            session = setup_session(cas_url, self.username, self.password, session=self.transport.create_session())
+            session.cookies.set("CASTGC", session.cookies.get_dict()['CASTGC'])
+            self._session = session
         url = f'https://{self.product_type}.cmems-du.eu/thredds/dodsC/{self.product}'
         try:
             # NetCDF4DataStore also supports OpenDAP
-            data_store = xarray.backends.PydapDataStore(open_url(url, session=session))
+            data_store = xarray.backends.PydapDataStore(open_url(url, session=self._session,
+                                                                 timeout=self.transport.read_timeout))
         except Exception as err:
             raise err
         return data_store
@@ -432,7 +906,7 @@ class DownloaderXarrayETOPONCEI(DownloaderXarray):
             logger.info(f"Save dataset to '{file_out}'")
             if '_NCProperties' in dataset_sub.attrs:
                 del dataset_sub.attrs['_NCProperties']
-            dataset_sub.to_netcdf(file_out)
+            self.save_dataset(dataset_sub, file_out)
 
         return dataset_sub
 
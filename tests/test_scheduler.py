@@ -0,0 +1,122 @@
+"""
+Tests of the fetch scheduler against a local stand-in server which injects faults (HTTP errors, dropped connections)
+"""
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from maridatadownloader import scheduler as scheduler_module
+from maridatadownloader.scheduler import FetchError, FetchScheduler
+
+
+class FaultInjectingHandler(BaseHTTPRequestHandler):
+    """Answers GET /<name> with the body <name> after the faults planned for the path have been injected"""
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits[self.path] += 1
+            plan = server.faults.get(self.path, [])
+            fault = plan.pop(0) if plan else None
+        if fault == 'drop':
+            # Close the connection without sending a response
+            self.close_connection = True
+            return
+        status = fault or 200
+        body = self.path.lstrip('/').encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FaultInjectingHandler)
+    httpd.lock = threading.Lock()
+    httpd.hits = defaultdict(int)
+    httpd.faults = {}
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """Record the backoff delays instead of sleeping"""
+    recorded = []
+    monkeypatch.setattr(scheduler_module.time, 'sleep', recorded.append)
+    return recorded
+
+
+def get(url):
+    response = requests.get(url, timeout=5)
+    response.raise_for_status()
+    return response.text
+
+
+def test_call_retries_transient_http_errors(server, delays):
+    server.faults['/a'] = [503, 429, 500]
+    scheduler = FetchScheduler(max_retries=5, backoff_base=0.5, backoff_max=1.0)
+    assert scheduler.call(server.url, get, f'{server.url}/a') == 'a'
+    assert server.hits['/a'] == 4
+    assert len(delays) == 3
+    assert all(0 <= delay <= bound for delay, bound in zip(delays, [0.5, 1.0, 1.0]))
+
+
+def test_call_retries_dropped_connections(server, delays):
+    server.faults['/b'] = ['drop', 'drop']
+    scheduler = FetchScheduler(max_retries=2, backoff_base=0.01)
+    assert scheduler.call(server.url, get, f'{server.url}/b') == 'b'
+    assert server.hits['/b'] == 3
+
+
+def test_call_does_not_retry_permanent_errors(server, delays):
+    server.faults['/c'] = [404, 404]
+    scheduler = FetchScheduler(max_retries=5, backoff_base=0.01)
+    with pytest.raises(requests.HTTPError):
+        scheduler.call(server.url, get, f'{server.url}/c')
+    assert server.hits['/c'] == 1
+    assert delays == []
+
+
+def test_call_gives_up_after_max_retries(server, delays):
+    server.faults['/d'] = [503] * 10
+    scheduler = FetchScheduler(max_retries=2, backoff_base=0.01)
+    with pytest.raises(requests.HTTPError):
+        scheduler.call(server.url, get, f'{server.url}/d')
+    assert server.hits['/d'] == 3
+
+
+def test_backoff_delay_is_bounded():
+    scheduler = FetchScheduler(backoff_base=1.0, backoff_max=8.0)
+    for attempt in range(1, 10):
+        bound = min(8.0, 2.0 ** (attempt - 1))
+        assert all(0 <= scheduler.get_backoff_delay(attempt) <= bound for _ in range(100))
+
+
+def test_fetch_all_resumes_from_completed_pieces(server, delays):
+    names = ['p0', 'p1', 'p2', 'p3', 'p4']
+    urls = [f'{server.url}/{name}' for name in names]
+    server.faults['/p3'] = [503] * 2
+    scheduler = FetchScheduler(max_retries=1, backoff_base=0.01)
+
+    with pytest.raises(FetchError) as excinfo:
+        scheduler.fetch_all(urls, get)
+    completed = excinfo.value.completed
+    assert sorted(completed) == sorted(url for url in urls if not url.endswith('/p3'))
+    assert list(excinfo.value.errors) == [f'{server.url}/p3']
+
+    hits = dict(server.hits)
+    assert scheduler.fetch_all(urls, get, completed=completed) == names
+    # Only the failed piece is fetched again
+    assert {path: count - hits[path] for path, count in server.hits.items()} == {
+        '/p0': 0, '/p1': 0, '/p2': 0, '/p3': 1, '/p4': 0}
@@ -0,0 +1,135 @@
+"""
+Tests of the point query service using a downloader over an in-memory dataset
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray
+
+from maridatadownloader.service import PointQueryService
+from maridatadownloader.xarray import DownloaderXarray
+
+DATASET = xarray.Dataset(
+    {'temperature': (('time', 'latitude', 'longitude'),
+                     np.random.default_rng(0).normal(280., 5., size=(48, 41, 41)))},
+    coords={'time': pd.date_range('2024-01-01', periods=48, freq='1h'),
+            'latitude': np.arange(-10., 10.25, 0.5),
+            'longitude': np.arange(0., 20.25, 0.5)})
+
+
+class DownloaderInMemory(DownloaderXarray):
+    """Serves DATASET and counts the download calls. Fails all downloads if `error` is set."""
+    def __init__(self, error=None, **kwargs):
+        self.error = error
+        self.n_downloads = 0
+        super().__init__('memory', **kwargs)
+
+    def download(self, parameters=None, sel_dict=None, isel_dict=None, file_out=None, interpolate=False, **kwargs):
+        self.n_downloads += 1
+        if self.error is not None:
+            raise self.error
+        return super().download(parameters, sel_dict, isel_dict, file_out, interpolate, **kwargs)
+
+    def get_filename_or_obj(self, **kwargs):
+        return DATASET
+
+    def open_dataset(self, filename_or_obj=None):
+        self.dataset = self.filename_or_obj
+
+
+@pytest.fixture
+def downloader():
+    return DownloaderInMemory()
+
+
+def query_burst(service, queries):
+    """Submit all queries at once from separate threads and return the results (or raised errors) in order"""
+    results = [None] * len(queries)
+    barrier = threading.Barrier(len(queries))
+
+    def run(n, query):
+        barrier.wait()
+        try:
+            results[n] = service.query(*query, timeout=10)
+        except Exception as err:
+            results[n] = err
+
+    threads = [threading.Thread(target=run, args=(n, query)) for n, query in enumerate(queries)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def expected_value(time, latitude, longitude):
+    time = pd.Timestamp(time).to_datetime64().astype(DATASET['time'].dtype)
+    return float(DATASET['temperature'].interp(time=time, latitude=latitude, longitude=longitude))
+
+
+def test_burst_is_answered_in_one_batch(downloader):
+    rng = np.random.default_rng(1)
+    times = pd.Timestamp('2024-01-01T01:00') + pd.to_timedelta(rng.uniform(0, 20, 50), unit='h')
+    queries = [('memory', time, lat, lon) for time, lat, lon in zip(times, rng.uniform(0.2, 4.8, 50),
+                                                                        rng.uniform(5.2, 9.8, 50))]
+    with PointQueryService(max_batch_size=50, max_wait=5.) as service:
+        service.add_dataset('memory', downloader, parameters='temperature')
+        results = query_burst(service, queries)
+        stats = service.get_stats()
+
+    assert stats['batches'] == 1
+    assert stats['queries'] == 50
+    # All queries fall into the same block
+    assert stats['blocks_interpolated'] == 1
+    assert downloader.n_downloads == 1
+    for (_, time, lat, lon), result in zip(queries, results):
+        assert result['temperature'] == pytest.approx(expected_value(time, lat, lon))
+
+
+def test_block_cache_hits_and_misses(downloader):
+    with PointQueryService(cache_size=2, max_wait=0.) as service:
+        service.add_dataset('memory', downloader, parameters='temperature')
+        service.query('memory', '2024-01-01T06:00', 1.0, 6.0)
+        service.query('memory', '2024-01-01T07:30', 2.3, 7.1)
+        assert (service.get_stats()['cache_hits'], service.get_stats()['cache_misses']) == (1, 1)
+
+        # Other spatial blocks, the first block is evicted (least recently used)
+        service.query('memory', '2024-01-01T06:00', -3.0, 6.0)
+        service.query('memory', '2024-01-01T06:00', 1.0, 12.0)
+        result = service.query('memory', '2024-01-01T06:00', 1.0, 6.0)
+        stats = service.get_stats()
+        assert (stats['cache_hits'], stats['cache_misses']) == (1, 4)
+        assert downloader.n_downloads == 4
+        assert result['temperature'] == pytest.approx(expected_value('2024-01-01T06:00', 1.0, 6.0))
+
+        service.clear_cache()
+        service.query('memory', '2024-01-01T06:00', 1.0, 6.0)
+        assert service.get_stats()['cache_misses'] == 5
+
+
+def test_errors_are_propagated_to_callers(downloader):
+    failing_downloader = DownloaderInMemory(error=OSError('server unavailable'))
+    queries = [('memory', '2024-01-01T06:00', 1.0 + n * 0.1, 6.0) for n in range(5)]
+    queries += [('failing', '2024-01-01T06:00', 1.0 + n * 0.1, 6.0) for n in range(5)]
+    with PointQueryService(max_batch_size=10, max_wait=5.) as service:
+        service.add_dataset('memory', downloader, parameters='temperature')
+        service.add_dataset('failing', failing_downloader, parameters='temperature')
+        results = query_burst(service, queries)
+        stats = service.get_stats()
+
+        with pytest.raises(ValueError):
+            service.query('unknown', '2024-01-01T06:00', 1.0, 6.0)
+
+    assert stats['batches'] == 1
+    assert stats['errors'] == 5
+    # Only the queries of the failing dataset are affected
+    for (name, time, lat, lon), result in zip(queries, results):
+        if name == 'failing':
+            assert isinstance(result, OSError) and str(result) == 'server unavailable'
+        else:
+            assert result['temperature'] == pytest.approx(expected_value(time, lat, lon))
+
+    with pytest.raises(RuntimeError):
+        service.query('memory', '2024-01-01T06:00', 1.0, 6.0)